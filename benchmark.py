@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+import time, json, gzip, random, shutil, tempfile, argparse, resource, platform, datetime
+from StringIO import StringIO
+from os.path import join
+import numpy as np
+import changelib
+import changechange
+from bigmmap import BigMMap, MODE_PAGED, MODE_WHOLE
+from bulkload import BulkLoader
+from migrate import to_kv
+from db import database, apply_profile, SQLITE_PROFILES, NodeRef, WayRelRef, Members, State
+from changesetcache import ChangesetCache
+
+# Synthetic data resembles a planet extract: node ids follow each other along ways,
+# and edits in a diff gather around a few places, picking ids close to each other.
+HOTSPOTS = 5
+HOTSPOT_SPREAD = 2000
+CHANGESET_BASE = 1000000
+MEMBER_TYPES = {'n': 'node', 'w': 'way', 'r': 'relation'}
+
+
+class Synthetic(object):
+    """Generates a reproducible synthetic database and osmChange diffs."""
+
+    def __init__(self, nodes, ways, relations, seed):
+        self.node_count = nodes
+        self.way_count = ways
+        self.relation_count = relations
+        self.random = random.Random(seed)
+        self.np_random = np.random.RandomState(seed)
+        self.ways = {}
+        self.relations = {}
+        self.next_node = nodes + 1
+        self.next_way = ways + 1
+        self.versions = {}
+
+    def coords(self):
+        """Returns arrays of lats and lons for all nodes, a random walk, so close ids are close on the map."""
+        steps = self.np_random.normal(0, 0.0005, (self.node_count, 2))
+        walk = np.cumsum(steps, axis=0)
+        lats = np.mod(walk[:, 0] + 90, 170) - 85
+        lons = np.mod(walk[:, 1] + 180, 360) - 180
+        return np.round(lats, 7), np.round(lons, 7)
+
+    def way_nodes(self, center):
+        """Returns a list of consecutive node ids, sometimes with a junction node from nearby."""
+        start = max(1, min(center, self.node_count - 30))
+        nodes = range(start, start + self.random.randint(2, 30))
+        if self.random.random() < 0.3:
+            nodes.insert(self.random.randint(1, len(nodes) - 1), self.near(center))
+        return nodes
+
+    def near(self, center, limit=None):
+        """Returns an id close to the center."""
+        limit = limit or self.node_count
+        return max(1, min(limit, int(self.random.gauss(center, HOTSPOT_SPREAD))))
+
+    def generate_ways(self):
+        step = max(1, self.node_count // self.way_count)
+        for way_id in range(1, self.way_count + 1):
+            self.ways[way_id] = self.way_nodes((way_id - 1) * step + 1)
+        return sorted(self.ways.items())
+
+    def generate_relations(self):
+        for rel_id in range(1, self.relation_count + 1):
+            center = self.random.randint(1, self.way_count)
+            members = ['w' + str(self.near(center, self.way_count)) for i in range(self.random.randint(1, 10))]
+            members.append('n' + str(self.near(center * self.node_count // self.way_count)))
+            self.relations[rel_id] = members
+        return [(-rel_id, members) for rel_id, members in sorted(self.relations.items())]
+
+    def version(self, key):
+        self.versions[key] = self.versions.get(key, 1) + 1
+        return self.versions[key]
+
+    def diff(self, size):
+        """Returns an osmChange xml string with size elements: mostly moved nodes,
+        some new nodes and ways, changed ways and relations."""
+        hotspots = [self.random.randint(1, self.node_count) for i in range(HOTSPOTS)]
+        changeset = CHANGESET_BASE + self.random.randint(0, 999)
+        nodes, ways, relations, created_nodes, created_ways = {}, {}, {}, [], []
+        for i in range(size):
+            center = self.random.choice(hotspots)
+            r = self.random.random()
+            if r < 0.65:
+                nodes[self.near(center)] = None
+            elif r < 0.75:
+                created_nodes.append((self.next_node, center))
+                self.next_node += 1
+            elif r < 0.92:
+                ways[self.near(center * self.way_count // self.node_count, self.way_count)] = center
+            elif r < 0.95:
+                created_ways.append((self.next_way, center))
+                self.next_way += 1
+            else:
+                relations[self.random.randint(1, self.relation_count)] = None
+        out = ['<?xml version="1.0" encoding="UTF-8"?>\n<osmChange version="0.6" generator="benchmark">\n']
+        out.append('<create>\n')
+        for node_id, center in created_nodes:
+            out.append(self.node_xml(node_id, changeset, 1))
+        for way_id, center in created_ways:
+            self.ways[way_id] = self.way_nodes(center)
+            out.append(self.way_xml(way_id, changeset, 1))
+        out.append('</create>\n<modify>\n')
+        for node_id in sorted(nodes):
+            out.append(self.node_xml(node_id, changeset, self.version(('n', node_id))))
+        for way_id in sorted(ways):
+            self.ways[way_id] = self.way_nodes(ways[way_id])
+            out.append(self.way_xml(way_id, changeset, self.version(('w', way_id))))
+        for rel_id in sorted(relations):
+            members = self.relations[rel_id]
+            if self.random.random() < 0.5 and len(members) > 2:
+                members.pop(self.random.randrange(len(members)))
+            else:
+                members.insert(0, 'w' + str(self.random.randint(1, self.way_count)))
+            out.append('<relation id="{0}" version="{1}" changeset="{2}">{3}</relation>\n'.format(
+                rel_id, self.version(('r', rel_id)), changeset,
+                ''.join('<member type="{0}" ref="{1}" role=""/>'.format(
+                    MEMBER_TYPES[m[0]], m[1:]) for m in members)))
+        out.append('</modify>\n</osmChange>\n')
+        return ''.join(out)
+
+    def node_xml(self, node_id, changeset, version):
+        return '<node id="{0}" version="{1}" changeset="{2}" lat="{3:.7f}" lon="{4:.7f}"/>\n'.format(
+            node_id, version, changeset, self.random.uniform(-80, 80), self.random.uniform(-180, 180))
+
+    def way_xml(self, way_id, changeset, version):
+        return '<way id="{0}" version="{1}" changeset="{2}">{3}</way>\n'.format(
+            way_id, version, changeset, ''.join('<nd ref="{0}"/>'.format(n) for n in self.ways[way_id]))
+
+
+def gzip_string(data):
+    buf = StringIO()
+    gz = gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=1)
+    gz.write(data)
+    gz.close()
+    return buf.getvalue()
+
+
+def peak_rss():
+    """Returns peak resident memory of the process in megabytes."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def page_switches():
+    return sum(mm.page_switches for mm in (changelib.node_mmap, changelib.bbox_mmap, changelib.rel_bbox_mmap))
+
+
+class Measure(object):
+    """Measures time, mmap page switches and SQLite queries for a benchmark."""
+
+    def __init__(self, name, results):
+        self.name = name
+        self.results = results
+        self.elements = 0
+
+    def __enter__(self):
+        self.switches = page_switches()
+        self.queries = database.query_count
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            return
+        seconds = time.time() - self.start
+        result = {
+            'elements': self.elements,
+            'seconds': round(seconds, 4),
+            'per_second': round(self.elements / seconds, 1) if seconds > 0 else None,
+            'page_switches': page_switches() - self.switches,
+            'queries': database.query_count - self.queries,
+            'peak_rss_mb': round(peak_rss(), 1),
+        }
+        self.results[self.name] = result
+        print '{0:<20} {1:>9} elements {2:>9.3f} s {3:>12} /s {4:>6} switches {5:>8} queries {6:>8} MB'.format(
+            self.name, result['elements'], result['seconds'], result['per_second'],
+            result['page_switches'], result['queries'], result['peak_rss_mb'])
+
+
+def open_files(path, mode, page_size):
+    # Maps left open would stay resident and count in memory numbers
+    for mm in (changelib.node_mmap, changelib.bbox_mmap, changelib.rel_bbox_mmap):
+        if mm is not None:
+            mm.close()
+    changelib.node_mmap = BigMMap(join(path, 'nodes.bin'), page_size=page_size, mode=mode)
+    changelib.bbox_mmap = BigMMap(join(path, 'ways.bin'), page_size=page_size, mode=mode)
+    changelib.rel_bbox_mmap = BigMMap(join(path, 'relations.bin'), page_size=page_size, mode=mode)
+
+
+def build_database(path, syn, options):
+    database.init(join(path, 'changechange.db'))
+    database.connect()
+    apply_profile(options.sqlite_profile)
+    database.create_tables([NodeRef, WayRelRef, Members, State], safe=True)
+    open_files(path, options.mode, options.page_size)
+    changelib.CACHE = False
+    loader = BulkLoader()
+    lats, lons = syn.coords()
+    loader.add_coords(np.arange(1, syn.node_count + 1, dtype=np.int64), lats, lons)
+    loader.add_ways(syn.generate_ways())
+    loader.add_relations(syn.generate_relations())
+    loader.finish()
+    changelib.CACHE = True
+    # Changesets are known, so diffs do not query the API
+    changechange.changeset_cache = ChangesetCache(join(path, 'changesets'))
+    changechange.changeset_cache.put_many(dict(
+        (CHANGESET_BASE + i, '<changeset id="{0}"/>'.format(CHANGESET_BASE + i)) for i in range(1000)))
+    changelib.flush()
+
+
+def sample_ids(syn, count, limit):
+    """Returns ids with edit locality: runs around random hotspots."""
+    hotspots = [syn.random.randint(1, limit) for i in range(HOTSPOTS)]
+    return [max(1, min(limit, int(syn.random.gauss(syn.random.choice(hotspots), HOTSPOT_SPREAD)))) for i in range(count)]
+
+
+def run(options):
+    path = tempfile.mkdtemp(prefix='changechange-bench-')
+    results = {}
+    try:
+        syn = Synthetic(options.nodes, options.ways, options.relations, options.seed)
+        start = time.time()
+        build_database(path, syn, options)
+        if options.backend == 'kv':
+            to_kv(path)
+        changelib.db_store = changelib.ref_store = changelib.BACKENDS[options.backend](path, options.mode)
+        print 'Built a database in {0:.1f} s'.format(time.time() - start)
+        changechange.TARGET_OSC_PATH = join(path, 'out')
+        diffs = [gzip_string(syn.diff(options.diff_size)) for i in range(options.diffs)]
+        node_ids = sample_ids(syn, options.reads, options.nodes)
+        way_ids = sample_ids(syn, options.reads // 10, options.ways)
+
+        # Reopen the files, so every run starts with no pages mapped
+        open_files(path, options.mode, options.page_size)
+        with Measure('mmap_read', results) as m:
+            mm = changelib.node_mmap
+            for n in node_ids:
+                mm[n * 3]
+                mm[n * 3 + 1]
+            m.elements = len(node_ids)
+        with Measure('mmap_read_many', results) as m:
+            for i in range(0, len(node_ids), 1000):
+                changelib.node_mmap.get_records(node_ids[i:i + 1000], 3)
+            m.elements = len(node_ids)
+        changelib.set_cache_memory(options.node_cache, options.bbox_cache)
+        with Measure('fetch_node_tuple', results) as m:
+            for n in node_ids:
+                changelib.fetch_node_tuple(n)
+            m.elements = len(node_ids)
+        way_nodes = [syn.ways[w] for w in way_ids]
+        with Measure('calc_bbox', results) as m:
+            for nodes in way_nodes:
+                changelib.calc_bbox(nodes)
+            m.elements = len(way_nodes)
+        with Measure('update_way_nodes', results) as m:
+            with database.atomic():
+                changelib.begin_diff()
+                for w in way_ids:
+                    changelib.update_way_nodes(w, syn.way_nodes(syn.random.randint(1, options.nodes)))
+                changelib.end_diff()
+            m.elements = len(way_ids)
+        changelib.set_cache_memory(options.node_cache, options.bbox_cache)
+        with Measure('enrich_replication', results) as m:
+            for i, data in enumerate(diffs):
+                with database.atomic():
+                    changechange.enrich_replication(i + 1, data)
+            m.elements = len(diffs) * options.diff_size
+        changelib.close()
+        changechange.changeset_cache.close()
+    finally:
+        database.close()
+        shutil.rmtree(path, True)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks changelib and BigMMap with synthetic data.')
+    parser.add_argument('-o', '--output', help='JSON file for results')
+    parser.add_argument('--nodes', type=int, default=1000000, help='Number of nodes')
+    parser.add_argument('--ways', type=int, default=100000, help='Number of ways')
+    parser.add_argument('--relations', type=int, default=5000, help='Number of relations')
+    parser.add_argument('--diffs', type=int, default=10, help='Number of diffs to enrich')
+    parser.add_argument('--diff-size', type=int, default=2000, help='Number of elements in a diff')
+    parser.add_argument('--reads', type=int, default=200000, help='Number of node reads')
+    parser.add_argument('--mode', choices=(MODE_PAGED, MODE_WHOLE), default=changelib.DEFAULT_MMAP_MODE,
+                        help='Mapping mode for binary files')
+    parser.add_argument('--page-size', type=int, default=64, help='Page size in megabytes, for the paged mode')
+    parser.add_argument('--node-cache', type=int, default=changelib.NODE_CACHE_MEMORY,
+                        help='Node cache size in megabytes')
+    parser.add_argument('--bbox-cache', type=int, default=changelib.BBOX_CACHE_MEMORY,
+                        help='Way bbox cache size in megabytes')
+    parser.add_argument('--sqlite-profile', choices=sorted(SQLITE_PROFILES), default='performance',
+                        help='Set of SQLite pragmas')
+    parser.add_argument('--backend', choices=sorted(changelib.BACKENDS), default='sqlite',
+                        help='Store for reference lists')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed')
+    options = parser.parse_args()
+
+    results = run(options)
+    if options.output:
+        report = {
+            'time': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'python': platform.python_version(),
+            'options': vars(options),
+            'results': results,
+        }
+        with open(options.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
@@ -1,26 +1,187 @@
+import os
 import mmap
+import fcntl
 import struct
+import ctypes
+import ctypes.util
+import numpy as np
 from collections import deque, Counter
+from itertools import izip
+
+MODE_PAGED = 'paged'
+MODE_WHOLE = 'whole'
+
+# Python 2 mmap objects have no madvise() method, so these are Linux values
+# used with the libc call when the constants are missing.
+MADV_NORMAL = getattr(mmap, 'MADV_NORMAL', 0)
+MADV_RANDOM = getattr(mmap, 'MADV_RANDOM', 1)
+MADV_SEQUENTIAL = getattr(mmap, 'MADV_SEQUENTIAL', 2)
+MADV_WILLNEED = getattr(mmap, 'MADV_WILLNEED', 3)
+
+_libc = None
+
+
+def madvise(m, advice, start=0, length=None):
+    """Gives the kernel an access pattern hint for a part of an mmap.
+    Failures are ignored, since it's only a hint."""
+    global _libc
+    if length is None:
+        length = len(m) - start
+    # The start address must be aligned to the memory page
+    length += start % mmap.PAGESIZE
+    start -= start % mmap.PAGESIZE
+    length = min(length, len(m) - start)
+    if length <= 0:
+        return
+    if hasattr(m, 'madvise'):
+        try:
+            m.madvise(advice, start, length)
+        except (OSError, ValueError):
+            pass
+        return
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    view = np.frombuffer(m, dtype=np.uint8)
+    _libc.madvise(ctypes.c_void_p(view.ctypes.data + start), ctypes.c_size_t(length), advice)
+    del view
+
+
+class Overlay(object):
+    """Undecoded int32 values by offsets, written over a file. Most values
+    are kept in sorted arrays, so batches are merged with searchsorted,
+    and the latest ones in a dict, until there are MERGE_SIZE of them.
+    A bitmap of offset hashes lets reads skip offsets that were not written."""
+    MERGE_SIZE = 4096
+    # Bitmap slots for each value, so about one in this many reads is checked
+    FILTER_RATIO = 16
+
+    def __init__(self):
+        self.offsets = np.zeros(0, dtype=np.int64)
+        self.raw = np.zeros(0, dtype=np.int32)
+        self.recent = {}
+        self.filter = np.zeros(1 << 16, dtype=bool)
+
+    def _merge_arrays(self, offsets, raw):
+        # The sort is stable, so the last value for an offset is the newest one
+        order = np.argsort(offsets, kind='mergesort')
+        offsets = offsets[order]
+        raw = raw[order]
+        last = np.ones(len(offsets), dtype=bool)
+        last[:-1] = offsets[1:] != offsets[:-1]
+        offsets = offsets[last]
+        raw = raw[last]
+        pos = np.searchsorted(self.offsets, offsets)
+        if len(self.offsets):
+            existing = self.offsets[np.minimum(pos, len(self.offsets) - 1)] == offsets
+            self.raw[pos[existing]] = raw[existing]
+            new = ~existing
+            offsets, raw, pos = offsets[new], raw[new], pos[new]
+        self.offsets = np.insert(self.offsets, pos, offsets)
+        self.raw = np.insert(self.raw, pos, raw)
+        if len(self.offsets) * self.FILTER_RATIO > len(self.filter):
+            size = len(self.filter)
+            while size < len(self.offsets) * self.FILTER_RATIO:
+                size <<= 1
+            self.filter = np.zeros(size, dtype=bool)
+            self.filter[self.offsets & (size - 1)] = True
+        else:
+            self.filter[offsets & (len(self.filter) - 1)] = True
+
+    def _merge(self):
+        if self.recent:
+            count = len(self.recent)
+            offsets = np.fromiter(self.recent.iterkeys(), dtype=np.int64, count=count)
+            raw = np.fromiter(self.recent.itervalues(), dtype=np.int32, count=count)
+            self.recent = {}
+            self._merge_arrays(offsets, raw)
+
+    def get(self, offset):
+        """Returns a raw value for the offset, or None if it was not written."""
+        v = self.recent.get(offset)
+        if v is not None or not self.filter[offset & (len(self.filter) - 1)]:
+            return v
+        pos = int(np.searchsorted(self.offsets, offset))
+        if pos < len(self.offsets) and self.offsets[pos] == offset:
+            return int(self.raw[pos])
+        return None
+
+    def set(self, offset, v):
+        self.recent[offset] = v
+        self.filter[offset & (len(self.filter) - 1)] = True
+        if len(self.recent) >= self.MERGE_SIZE:
+            self._merge()
+
+    def set_many(self, offsets, raw):
+        if len(offsets) < self.MERGE_SIZE:
+            self.recent.update(izip(offsets.tolist(), raw.tolist()))
+            self.filter[offsets & (len(self.filter) - 1)] = True
+            if len(self.recent) >= self.MERGE_SIZE:
+                self._merge()
+        else:
+            # Older values in the dict go first
+            self._merge()
+            self._merge_arrays(offsets, raw)
+
+    def apply(self, offsets, raw):
+        """Replaces values in a raw array read from the file at given offsets."""
+        candidates = np.nonzero(self.filter[offsets & (len(self.filter) - 1)])[0]
+        if not len(candidates):
+            return
+        offsets = offsets[candidates]
+        if len(self.offsets):
+            pos = np.searchsorted(self.offsets, offsets)
+            pos[pos == len(self.offsets)] = 0
+            found = self.offsets[pos] == offsets
+            raw[candidates[found]] = self.raw[pos[found]]
+        if self.recent:
+            recent = self.recent
+            for i, offset in izip(candidates.tolist(), offsets.tolist()):
+                v = recent.get(offset)
+                if v is not None:
+                    raw[i] = v
+
+    def values(self):
+        """Returns sorted arrays of offsets and raw values."""
+        self._merge()
+        return self.offsets, self.raw
 
 
 class BigMMap:
-    """An mmap of int32 numbers contained in a very big file."""
+    """An mmap of int32 numbers contained in a very big file.
+
+    In the paged mode, only mmap_count windows of page_size MiB are kept open.
+    The whole mode maps the entire file once, which needs a 64-bit address space.
+    The advice is passed to madvise() for the whole file in that mode.
+
+    The file is created if missing, and grows in page_size steps when a value
+    is written past its end. It is extended with ftruncate(), so unwritten
+    parts are holes that take no disk space and are read as None.
+
+    Between begin_overlay() and commit_overlay(), writes are kept in memory
+    and the file is not changed, so they can be journaled first."""
     ZERO_VALUE = 0x7FFFFFFE
 
-    def __init__(self, filename, mmap_count=2, page_size=64):
+    def __init__(self, filename, mmap_count=2, page_size=64, mode=MODE_PAGED, advice=None):
         self.page_size = page_size * 1024 * 1024
         self.mmap_count = mmap_count
         self.history_size = 1000
+        self.whole = mode == MODE_WHOLE
+        self.advice = advice
         try:
-            self.f = open(filename, 'r+b')
+            self.f = os.fdopen(os.open(filename, os.O_RDWR | os.O_CREAT, 0o644), 'r+b')
             self.f.seek(0, 2)
             self.length = self.f.tell()
-        except IOError:
+        except (IOError, OSError):
             self.f = None
             self.length = 0
         self.map = {}
         self.access_count = Counter()
         self.accessed_pages = deque()
+        # Number of times a page was mapped, and closed to map another one
+        self.page_switches = 0
+        self.page_evictions = 0
+        # An Overlay of written values kept in memory
+        self.pending = None
 
     def flush(self, page=None):
         if page is not None:
@@ -43,10 +204,56 @@ class BigMMap:
             if self.f is not None:
                 self.f.close()
 
+    def reserve(self, count):
+        """Makes sure the file can hold `count` values, extending it sparsely if needed."""
+        if self.f is None or count << 2 <= self.length:
+            return
+        step = max(self.page_size << 2, mmap.ALLOCATIONGRANULARITY)
+        new_length = ((count << 2) + step - 1) // step * step
+        self.f.flush()
+        # Another process could be extending the file, and it must not be shrunk
+        fcntl.flock(self.f.fileno(), fcntl.LOCK_EX)
+        try:
+            new_length = max(new_length, os.fstat(self.f.fileno()).st_size)
+            os.ftruncate(self.f.fileno(), new_length)
+        finally:
+            fcntl.flock(self.f.fileno(), fcntl.LOCK_UN)
+        self._set_length(new_length)
+
+    def refresh_length(self):
+        """Picks up the file length, in case it was extended by another process."""
+        if self.f is not None:
+            length = os.fstat(self.f.fileno()).st_size
+            if length > self.length:
+                self._set_length(length)
+
+    def _set_length(self, new_length):
+        old_length = self.length
+        self.length = new_length
+        # Maps that end at the old file length are too short now
+        if self.whole:
+            self.close(0)
+        else:
+            last_page = ((old_length >> 2) - 1) // self.page_size
+            if last_page in self.map:
+                self.close(last_page)
+
+    def _map_whole(self):
+        self.map[0] = mmap.mmap(self.f.fileno(), self.length)
+        self.page_switches += 1
+        if self.advice is not None:
+            madvise(self.map[0], self.advice)
+        return self.map[0]
+
     def _get_page(self, offset):
         """Returns a tuple (mmap, adj. offset)."""
-        if (offset << 2) + 4 >= self.length:
+        if (offset << 2) + 4 > self.length:
             raise ValueError('Offset {0} is outside the file length {1}.'.format(offset, self.length >> 2))
+        if self.whole:
+            m = self.map.get(0)
+            if m is None:
+                m = self._map_whole()
+            return (m, offset << 2)
         page = offset / self.page_size
         if page not in self.map:
             if len(self.map) >= self.mmap_count:
@@ -58,9 +265,13 @@ class BigMMap:
                         m = i
                         usage = self.access_count[i]
                 self.close(m)
+                self.page_evictions += 1
             fofs = page * self.page_size << 2
             flen = min(self.page_size << 2, self.length - fofs)
             self.map[page] = mmap.mmap(self.f.fileno(), flen, offset=fofs)
+            self.page_switches += 1
+            if self.advice is not None:
+                madvise(self.map[page], self.advice)
         # Update counts
         self.access_count[page] += 1
         self.accessed_pages.append(page)
@@ -68,15 +279,174 @@ class BigMMap:
             self.access_count[self.accessed_pages.popleft()] -= 1
         return (self.map[page], (offset - page * self.page_size) << 2)
 
+    def _page_groups(self, offsets):
+        """Splits an array of offsets by page, yielding (mask, page offset) tuples."""
+        if len(offsets) == 0:
+            return
+        if (int(offsets.max()) << 2) + 4 > self.length or offsets.min() < 0:
+            raise ValueError('Offsets {0}..{1} are outside the file length {2}.'.format(
+                offsets.min(), offsets.max(), self.length >> 2))
+        if self.whole:
+            yield (slice(None), 0)
+            return
+        pages = offsets // self.page_size
+        for page in np.unique(pages):
+            yield (pages == page, int(page) * self.page_size)
+
+    def _view(self, page_offset):
+        """Returns a zero-copy int32 array over the page starting at a given offset.
+        The view must be released before the page can be closed."""
+        m = self._get_page(page_offset)[0]
+        return np.frombuffer(m, dtype='<i4')
+
+    def _read_file(self, offsets):
+        """Reads undecoded values at given offsets into an int32 array."""
+        raw = np.zeros(len(offsets), dtype=np.int32)
+        if self.f is None:
+            return raw
+        # Values past the end of file are empty
+        inside = offsets < (self.length >> 2)
+        if not inside.all():
+            self.refresh_length()
+            inside = offsets < (self.length >> 2)
+        if not inside.all():
+            inside = np.nonzero(inside)[0]
+            raw[inside] = self._read_file(offsets[inside])
+            return raw
+        for mask, page_offset in self._page_groups(offsets):
+            view = self._view(page_offset)
+            raw[mask] = view[offsets[mask] - page_offset]
+            del view
+        return raw
+
+    def _read_raw(self, offsets):
+        """Same as _read_file, but with pending values in place of the file ones."""
+        raw = self._read_file(offsets)
+        if self.pending is not None:
+            self.pending.apply(offsets, raw)
+        return raw
+
+    def get_raw(self, offsets):
+        """Same as get_many, but returns undecoded values: 0 for None and ZERO_VALUE for 0.
+        Saves the cost of a masked array for short reads."""
+        return self._read_raw(np.asarray(offsets, dtype=np.int64))
+
+    def get_many(self, offsets):
+        """Reads values at given offsets into a masked int32 array, None values masked out."""
+        raw = self._read_raw(np.asarray(offsets, dtype=np.int64))
+        result = np.ma.masked_equal(raw, 0, copy=False)
+        result[raw == self.ZERO_VALUE] = 0
+        return result
+
+    def get_records(self, index, width):
+        """Reads records of `width` consecutive values, starting at index * width.
+        Returns a masked 2-dimensional array, one row per index."""
+        index = np.asarray(index, dtype=np.int64)
+        offsets = (index * width)[:, np.newaxis] + np.arange(width)
+        return self.get_many(offsets.ravel()).reshape(len(index), width)
+
+    def set_many(self, offsets, values):
+        """Writes a sequence of values (None or masked for empty) to given offsets."""
+        if self.f is None:
+            return
+        offsets = np.asarray(offsets, dtype=np.int64)
+        if np.ma.isMaskedArray(values):
+            empty = np.ma.getmaskarray(values)
+            values = values.filled(0)
+        elif isinstance(values, np.ndarray):
+            empty = np.zeros(len(values), dtype=bool)
+        else:
+            empty = np.array([v is None for v in values], dtype=bool)
+            if empty.any():
+                values = [0 if v is None else v for v in values]
+        raw = np.asarray(values, dtype=np.int64)
+        if len(raw) and (raw.min() < -0x80000000 or raw.max() > 0x7FFFFFFF):
+            raise ValueError('Values do not fit into int32.')
+        raw = raw.astype(np.int32)
+        raw[raw == 0] = self.ZERO_VALUE
+        raw[empty] = 0
+        if self.pending is not None:
+            self.pending.set_many(offsets, raw)
+        else:
+            self.write_raw(offsets, raw)
+
+    def write_raw(self, offsets, raw):
+        """Writes undecoded int32 values to given offsets of the file."""
+        if self.f is None or len(offsets) == 0:
+            return
+        offsets = np.asarray(offsets, dtype=np.int64)
+        raw = np.asarray(raw, dtype=np.int32)
+        self.reserve(int(offsets.max()) + 1)
+        for mask, page_offset in self._page_groups(offsets):
+            view = self._view(page_offset)
+            view[offsets[mask] - page_offset] = raw[mask]
+            del view
+
+    def begin_overlay(self):
+        """Starts keeping written values in memory instead of writing them to the file.
+        Reads return pending values, until they are written with commit_overlay()."""
+        self.pending = Overlay()
+
+    def pending_values(self):
+        """Returns arrays of offsets and undecoded values written since begin_overlay()."""
+        return self.pending.values()
+
+    def commit_overlay(self):
+        offsets, raw = self.pending_values()
+        self.pending = None
+        self.write_raw(offsets, raw)
+
+    def drop_overlay(self):
+        self.pending = None
+
+    def set_records(self, index, width, values):
+        """Writes a (n, width) array of records, starting at index * width."""
+        index = np.asarray(index, dtype=np.int64)
+        offsets = (index * width)[:, np.newaxis] + np.arange(width)
+        if np.ma.isMaskedArray(values):
+            values = values.reshape(-1)
+        else:
+            values = [v for row in values for v in row]
+        self.set_many(offsets.ravel(), values)
+
+    def set_advice(self, advice):
+        """Changes the access pattern hint for mapped and future pages."""
+        self.advice = advice
+        for m in self.map.itervalues():
+            madvise(m, MADV_NORMAL if advice is None else advice)
+
+    def prefetch(self, offset, count):
+        """Tells the kernel that `count` values from `offset` will be needed soon.
+        In the paged mode, only affects pages that are already mapped."""
+        end = min(offset + count, self.length >> 2)
+        if self.f is None or end <= offset:
+            return
+        if self.whole:
+            pages = [0]
+            if 0 not in self.map:
+                self._map_whole()
+        else:
+            pages = [p for p in self.map if p * self.page_size < end and (p + 1) * self.page_size > offset]
+        for page in pages:
+            start = max(offset - page * self.page_size, 0)
+            madvise(self.map[page], MADV_WILLNEED, start << 2,
+                    (end - page * self.page_size - start) << 2)
+
     def __len__(self):
         return self.length >> 2
 
     def __getitem__(self, offset):
         if self.f is None:
             return None
-        m = self._get_page(offset)
-        s = m[0][m[1]:m[1] + 4]
-        v = struct.unpack('<l', s)[0]
+        v = self.pending.get(offset) if self.pending is not None else None
+        if v is None:
+            if (offset << 2) + 4 > self.length:
+                self.refresh_length()
+                if (offset << 2) + 4 > self.length:
+                    return None
+            m = self._get_page(offset)
+            s = m[0][m[1]:m[1] + 4]
+            v = struct.unpack('<l', s)[0]
         if v == 0:
             return None
         elif v == self.ZERO_VALUE:
@@ -98,5 +468,9 @@ class BigMMap:
         except struct.error as e:
             print 'Erroneous value:', v
             raise e
+        if self.pending is not None:
+            self.pending.set(offset, v)
+            return
+        self.reserve(offset + 1)
         m = self._get_page(offset)
         m[0][m[1]:m[1] + 4] = s
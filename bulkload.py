@@ -0,0 +1,296 @@
+import os
+import sqlite3
+import multiprocessing
+import numpy as np
+import changelib
+from bigmmap import MADV_RANDOM, MADV_SEQUENTIAL
+from db import database, NodeRef, WayRelRef, Members
+from refstore import pack_ids, encode_member
+
+# Number of node references and members collected before writing a batch
+BATCH_SIZE = 5000000
+# Ways and relations are split between workers in ranges of this size
+PARTITION_SIZE = 1 << 20
+# SQLite can attach only 10 databases by default
+MAX_WORKERS = 8
+
+
+class StageLoader(object):
+    """Collects ways and relations in batches and writes them into a staging
+    database with executemany(): members as they are, and (id, ref) pairs
+    for back references of nodes, ways and relations."""
+
+    def __init__(self, stage_file, batch_size=BATCH_SIZE):
+        self.batch_size = batch_size
+        self.stage_file = stage_file
+        if os.path.exists(stage_file):
+            os.remove(stage_file)
+        self.conn = sqlite3.connect(stage_file)
+        self.conn.execute('PRAGMA journal_mode = OFF')
+        self.conn.execute('PRAGMA synchronous = OFF')
+        self.conn.execute('CREATE TABLE members (wr_id INTEGER, members BLOB)')
+        self.conn.execute('CREATE TABLE noderef (node_id INTEGER, ref INTEGER)')
+        self.conn.execute('CREATE TABLE wayrelref (wr_id INTEGER, ref INTEGER)')
+        self._reset()
+
+    def _reset(self):
+        self.members = []
+        self.node_refs = []
+        self.wr_refs = []
+        self.size = 0
+
+    def add_way(self, way_id, nodes):
+        self.members.append((way_id, sqlite3.Binary(pack_ids(nodes))))
+        self.node_refs.extend((n, way_id) for n in nodes)
+        self.size += len(nodes) + 1
+        if self.size >= self.batch_size:
+            self.flush()
+
+    def add_relation(self, rel_id, members):
+        self.members.append((rel_id, sqlite3.Binary(pack_ids([encode_member(m) for m in members]))))
+        for m in members:
+            ref = int(m[1:])
+            if m[0] == 'n':
+                self.node_refs.append((ref, rel_id))
+            else:
+                self.wr_refs.append((ref if m[0] == 'w' else -ref, rel_id))
+        self.size += len(members) + 1
+        if self.size >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        with self.conn:
+            self.conn.executemany('INSERT INTO members VALUES (?, ?)', self.members)
+            self.conn.executemany('INSERT INTO noderef VALUES (?, ?)', self.node_refs)
+            self.conn.executemany('INSERT INTO wayrelref VALUES (?, ?)', self.wr_refs)
+        self._reset()
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+
+def _unique_rows(rows):
+    """Removes duplicates from sorted (id, ref) rows, and returns
+    unique ids, and an array of refs for each."""
+    unique = np.ones(len(rows), dtype=bool)
+    unique[1:] = (rows[1:] != rows[:-1]).any(axis=1)
+    rows = rows[unique]
+    keys, starts = np.unique(rows[:, 0], return_index=True)
+    return keys, np.split(rows[:, 1], starts[1:])
+
+
+def _sorted_chunks(cursor, batch_size):
+    """Reads sorted (id, ref) rows in chunks, not splitting rows for one id."""
+    rest = np.zeros((0, 2), dtype=np.int64)
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        rows = np.vstack((rest, np.array(rows, dtype=np.int64)))
+        # The last id can continue in the next chunk
+        cut = np.searchsorted(rows[:, 0], rows[-1, 0])
+        if cut > 0:
+            yield rows[:cut]
+        rest = rows[cut:]
+    if len(rest):
+        yield rest
+
+
+def _store_node_refs(conn, chunk, table):
+    """Writes the first reference for each node to nodes.bin, and the rest to
+    the table. Returns (way id, lat, lon) for all ways referencing nodes."""
+    nodes, refs = _unique_rows(chunk)
+    changelib.node_mmap.prefetch(int(nodes[0]) * 3, (int(nodes[-1]) - int(nodes[0]) + 1) * 3)
+    changelib.node_mmap.set_many(nodes * 3 + 2, np.array([r[0] for r in refs], dtype=np.int64))
+    conn.executemany('INSERT INTO {0} (node_id, refs) VALUES (?, ?)'.format(table),
+                     ((n, sqlite3.Binary(pack_ids(r[1:]))) for n, r in zip(nodes.tolist(), refs) if len(r) > 1))
+    # Nodes are sorted, so this is a sequential read
+    coords = changelib.node_mmap.get_records(nodes, 3)[:, :2]
+    counts = np.array([len(r) for r in refs])
+    known = np.repeat(~np.ma.getmaskarray(coords).any(axis=1), counts)
+    coords = np.repeat(coords.data, counts, axis=0)
+    ways = np.concatenate(refs)
+    mask = known & (ways > 0)
+    return zip(ways[mask].tolist(), coords[mask, 0].tolist(), coords[mask, 1].tolist())
+
+
+def _store_bboxes(conn, batch_size):
+    """Reduces way coordinates to bboxes and writes them to ways.bin in the order of ids."""
+    cursor = conn.execute('SELECT way_id, MIN(lat), MIN(lon), MAX(lat), MAX(lon) '
+                          'FROM temp.waycoord GROUP BY way_id ORDER BY way_id')
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        rows = np.array(rows, dtype=np.int64)
+        changelib.bbox_mmap.set_records(rows[:, 0], 4, np.ma.masked_array(rows[:, 1:]))
+
+
+def check_empty():
+    """Raises an exception if the database has objects already."""
+    if Members.select().exists():
+        raise Exception('Bulk import requires an empty database')
+
+
+def merge_stages(stage_files, batch_size=BATCH_SIZE):
+    """Moves staged rows into the main database, which must be empty. Node
+    references are sorted, so the first one for each node is written to nodes.bin
+    in a single sequential sweep, and others are packed into NodeRef rows.
+
+    Way bboxes are calculated in the same sweep: coordinates are read in the
+    order of node ids, stored with way ids, and then reduced in the order of
+    way ids, so neither file is accessed randomly. Relation bboxes are
+    calculated last, when indexes are back, since they need lookups.
+
+    Indexes are dropped before inserting and rebuilt afterwards."""
+    # Loaders check it before parsing, this is a safety net
+    check_empty()
+    conn = database.get_conn()
+    tables = [m._meta.db_table for m in (NodeRef, WayRelRef, Members)]
+    indexes = conn.execute(
+        "SELECT name, sql FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL "
+        "AND tbl_name IN (?, ?, ?)", tables).fetchall()
+    for name, sql in indexes:
+        conn.execute('DROP INDEX "{0}"'.format(name))
+    stages = ['stage{0}'.format(i) for i in range(len(stage_files))]
+    for stage, filename in zip(stages, stage_files):
+        conn.execute('ATTACH DATABASE ? AS {0}'.format(stage), (filename,))
+    conn.execute('CREATE TEMP TABLE waycoord (way_id INTEGER, lat INTEGER, lon INTEGER)')
+
+    def union(table, key):
+        return conn.execute(' UNION ALL '.join(
+            'SELECT {0}, ref FROM {1}.{2}'.format(key, stage, table) for stage in stages) + ' ORDER BY 1, 2')
+
+    # Both files are swept in the order of ids, so readahead pays off
+    changelib.node_mmap.set_advice(MADV_SEQUENTIAL)
+    changelib.bbox_mmap.set_advice(MADV_SEQUENTIAL)
+    with database.atomic():
+        for stage in stages:
+            conn.execute('INSERT INTO {0} (wr_id, members) SELECT wr_id, members FROM {1}.members'.format(
+                Members._meta.db_table, stage))
+        for rows in _sorted_chunks(union('noderef', 'node_id'), batch_size):
+            conn.executemany('INSERT INTO temp.waycoord VALUES (?, ?, ?)',
+                             _store_node_refs(conn, rows, tables[0]))
+        for rows in _sorted_chunks(union('wayrelref', 'wr_id'), batch_size):
+            keys, refs = _unique_rows(rows)
+            conn.executemany('INSERT INTO {0} (wr_id, refs) VALUES (?, ?)'.format(tables[1]),
+                             ((k, sqlite3.Binary(pack_ids(r))) for k, r in zip(keys.tolist(), refs)))
+    _store_bboxes(conn, batch_size)
+    changelib.flush()
+    changelib.node_mmap.set_advice(MADV_RANDOM)
+    changelib.bbox_mmap.set_advice(MADV_RANDOM)
+    conn.execute('DROP TABLE temp.waycoord')
+    for stage, filename in zip(stages, stage_files):
+        conn.execute('DETACH DATABASE {0}'.format(stage))
+        os.remove(filename)
+    for name, sql in indexes:
+        conn.execute(sql)
+    changelib.rebuild_relation_bboxes()
+    changelib.flush()
+
+
+class BulkLoader(object):
+    """Imports ways and relations into an empty database, bypassing peewee
+    and per-object changelib calls. Objects are collected in a staging
+    database next to the main one and merged into it in finish()."""
+
+    def __init__(self, batch_size=BATCH_SIZE):
+        check_empty()
+        self.stage = StageLoader(database.database + '.bulk', batch_size)
+        self.batch_size = batch_size
+
+    def add_coords(self, node_ids, lats, lons):
+        changelib.store_node_coords_many(node_ids, lats, lons)
+
+    def add_ways(self, ways):
+        for way in ways:
+            self.stage.add_way(*way)
+
+    def add_relations(self, relations):
+        for rel in relations:
+            self.stage.add_relation(*rel)
+
+    def finish(self):
+        self.stage.close()
+        merge_stages([self.stage.stage_file], self.batch_size)
+
+
+def _worker(path, stage_file, batch_size, jobs):
+    """Stores node coordinates and stages ways and relations from the queue."""
+    changelib.CACHE = False
+    changelib.open(path, store='sqlite')
+    stage = StageLoader(stage_file, batch_size)
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        if job[0] == 'coords':
+            # The parent has extended the file for the block
+            changelib.node_mmap.refresh_length()
+            changelib.store_node_coords_many(*job[1:])
+        elif job[0] == 'way':
+            for way in job[1]:
+                stage.add_way(*way)
+        elif job[0] == 'relation':
+            for rel in job[1]:
+                stage.add_relation(*rel)
+    stage.close()
+    changelib.close()
+
+
+class ParallelLoader(BulkLoader):
+    """Same as BulkLoader, but with worker processes. Blocks of node coordinates
+    are written by workers into disjoint ranges of nodes.bin, and ways and relations
+    are partitioned by id ranges, each worker having its own staging database.
+    Node references are assigned only when merging, so workers never write
+    to the same place."""
+
+    def __init__(self, path, workers, batch_size=BATCH_SIZE):
+        check_empty()
+        self.batch_size = batch_size
+        self.next_worker = 0
+        self.stage_files = ['{0}.bulk{1}'.format(database.database, i) for i in range(workers)]
+        self.queues = []
+        self.processes = []
+        for stage_file in self.stage_files:
+            jobs = multiprocessing.Queue(16)
+            p = multiprocessing.Process(target=_worker, args=(path, stage_file, batch_size // workers, jobs))
+            p.daemon = True
+            p.start()
+            self.queues.append(jobs)
+            self.processes.append(p)
+
+    def _partition(self, ident):
+        return (abs(ident) // PARTITION_SIZE) % len(self.queues)
+
+    def add_coords(self, node_ids, lats, lons):
+        # Only the parent extends nodes.bin, so workers do not remap it at once
+        if len(node_ids):
+            changelib.node_mmap.reserve((int(np.max(node_ids)) + 1) * 3)
+        # Every node is written once, so any worker can take any block
+        self.queues[self.next_worker].put(('coords', node_ids, lats, lons))
+        self.next_worker = (self.next_worker + 1) % len(self.queues)
+
+    def _add_many(self, typ, objects):
+        parts = [[] for q in self.queues]
+        for obj in objects:
+            parts[self._partition(obj[0])].append(obj)
+        for jobs, part in zip(self.queues, parts):
+            if part:
+                jobs.put((typ, part))
+
+    def add_ways(self, ways):
+        self._add_many('way', ways)
+
+    def add_relations(self, relations):
+        self._add_many('relation', relations)
+
+    def finish(self):
+        for jobs in self.queues:
+            jobs.put(None)
+        for p in self.processes:
+            p.join()
+            if p.exitcode != 0:
+                raise Exception('Import worker failed with code {0}'.format(p.exitcode))
+        merge_stages(self.stage_files, self.batch_size)
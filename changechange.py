@@ -1,23 +1,74 @@
 #!/usr/bin/env python
-import os, sys, urllib2, gzip, re, datetime
+import os, sys, re, time, signal, datetime, argparse
+from itertools import izip, count
 from StringIO import StringIO
 from lxml import etree
+from download import Downloader
+from enrich import Pipeline, TAGS
+from gzipstream import ThreadedGunzipReader
+from oscwriter import OscWriter, COMPRESS_LEVEL
+from changesetcache import ChangesetCache, PARTITIONS
 import db
 import changelib
+import metrics
 
-path = os.path.dirname(sys.argv[0]) if len(sys.argv) < 2 or not os.path.exists(sys.argv[1]) else sys.argv[1]
 REPLICATION_BASE_URL = 'http://planet.openstreetmap.org/replication'
 API_BASE_URL = 'http://api.openstreetmap.org/api/0.6'
 TARGET_OSC_PATH = os.path.dirname(sys.argv[0])
+# Quotes inside attribute values are escaped, so this matches only attributes
+CHANGESET_RE = re.compile(r'\schangeset="(\d+)"')
+API_CHANGESETS_LIMIT = 100
+DB_QUERY_LIMIT = 500
+# Number of elements of the same type enriched together
+CHUNK_SIZE = 1000
+# Changesets are kept in the cache for this many days
+CHANGESET_DAYS = 2
+CHANGESET_CLEANUP_INTERVAL = 3600
+POLL_INTERVAL = 15
+MAX_POLL_INTERVAL = 300
+GRANULARITIES = ('minute', 'hour', 'day')
+PERIODS = {'minute': 60, 'hour': 3600, 'day': 86400}
+downloader = Downloader()
+pipeline = Pipeline()
+changeset_cache = None
+stop_requested = False
+# (granularity, sequence) -> (sequence, timestamp), these never change
+replication_states = {}
+
+
+def parse_replication_state(data):
+    """Returns a (sequence, timestamp) tuple from a state.txt contents."""
+    seq = int(re.search(r'sequenceNumber=(\d+)', data).group(1))
+    m = re.search(r'timestamp=(\S+)', data)
+    timestamp = datetime.datetime.strptime(m.group(1).replace('\\', ''), '%Y-%m-%dT%H:%M:%SZ')
+    return (seq, timestamp)
+
+
+def download_replication_state(granularity, seq=None):
+    """Downloads state of a given replication sequence, or the last one."""
+    if seq is None:
+        return parse_replication_state(downloader.fetch('{0}/{1}/state.txt'.format(REPLICATION_BASE_URL, granularity)))
+    key = (granularity, seq)
+    if key not in replication_states:
+        data = downloader.fetch(get_replication_url(seq, granularity, 'state.txt'))
+        replication_states[key] = parse_replication_state(data)
+    return replication_states[key]
+
+
+def prune_replication_states(minute_seq):
+    """Forgets states older than the given minute sequence, which are not
+    needed for planning anymore, so a daemon does not accumulate them."""
+    current = replication_states.get(('minute', minute_seq))
+    for key, (seq, timestamp) in replication_states.items():
+        if (key[0] == 'minute' and seq < minute_seq) or (current is not None and timestamp < current[1]):
+            del replication_states[key]
 
 
 def download_last_state():
     """Downloads last data and changeset replication seq number."""
-    state = urllib2.urlopen(REPLICATION_BASE_URL + '/minute/state.txt').read()
-    m = re.search(r'sequenceNumber=(\d+)', state)
-    seq1 = int(m.group(1))
+    seq1 = download_replication_state('minute')[0]
 
-    state = urllib2.urlopen(REPLICATION_BASE_URL + '/changesets/state.yaml').read()
+    state = downloader.fetch(REPLICATION_BASE_URL + '/changesets/state.yaml')
     m = re.search(r'sequence:\s+(\d+)', state)
     seq2 = int(m.group(1))
     # Not checking to throw exception in case of an error
@@ -32,6 +83,26 @@ def read_last_state():
         return None
 
 
+def cache_stats():
+    stats = changelib.cache_stats()
+    stats['changeset'] = changeset_cache.stats()
+    return stats
+
+
+def collect_stats():
+    """Returns growing numbers for metrics: database queries,
+    cache hits and mmap page switches."""
+    stats = {'db.queries': db.database.query_count, 'db.query_seconds': db.database.query_time}
+    for name, st in cache_stats().iteritems():
+        for key in ('hits', 'misses', 'evictions'):
+            stats['cache.{0}.{1}'.format(name, key)] = st[key]
+    for name, mm in (('nodes', changelib.node_mmap), ('ways', changelib.bbox_mmap),
+                     ('relations', changelib.rel_bbox_mmap)):
+        stats['mmap.{0}.page_switches'.format(name)] = mm.page_switches
+        stats['mmap.{0}.page_evictions'.format(name)] = mm.page_evictions
+    return stats
+
+
 def write_last_state(state):
     try:
         st = db.State.get(db.State.id == 1)
@@ -42,139 +113,489 @@ def write_last_state(state):
     st.save()
 
 
-def get_replication_url(state, subdir):
-    return '{0}/{1}/{2:03}/{3:03}/{4:03}.{5}.gz'.format(
+def get_replication_url(state, subdir, suffix=None):
+    if suffix is None:
+        suffix = 'osm.gz' if subdir == 'changesets' else 'osc.gz'
+    return '{0}/{1}/{2:03}/{3:03}/{4:03}.{5}'.format(
             REPLICATION_BASE_URL,
             subdir,
             int(state / 1000000),
             int(state / 1000) % 1000,
             state % 1000,
-            'osm' if subdir == 'changesets' else 'osc')
+            suffix)
 
 
-def get_replication_target_path(state):
-    return os.path.join(TARGET_OSC_PATH, '{0:03}'.format(int(state / 1000000)), '{0:03}'.format(int(state / 1000) % 1000), '{0:03}.osc.gz'.format(state % 1000))
+def get_replication_target_path(state, granularity='minute'):
+    """Minutely diffs are written to the root of the target path,
+    others to a subdirectory named after their granularity."""
+    path = TARGET_OSC_PATH if granularity == 'minute' else os.path.join(TARGET_OSC_PATH, granularity)
+    return os.path.join(path, '{0:03}'.format(int(state / 1000000)), '{0:03}'.format(int(state / 1000) % 1000), '{0:03}.osc.gz'.format(state % 1000))
 
 
-def process_replication_changesets(state):
-    """Downloads replication archive for a given state, and returns a dict of changeset xml strings."""
-    response = urllib2.urlopen(get_replication_url(state, 'changesets'))
-    data = response.read()
-    gz = gzip.GzipFile(fileobj=StringIO(data))
-    for event, element in etree.iterparse(gz):
-        if element.tag == 'changeset':
-            try:
-                ch = db.Changeset.get(db.Changeset.changeset == int(element.get('id')))
-            except db.Changeset.DoesNotExist:
-                ch = db.Changeset()
-                ch.changeset = int(element.get('id'))
-            ch.timestamp = datetime.datetime.now()
-            ch.xml = etree.tostring(element)
-            ch.save()
-            element.clear()
-
-
-def fetch_changeset_from_api(changeset):
-    response = urllib2.urlopen('{0}/changeset/{1}'.format(API_BASE_URL, changeset))
-    return response.read()
-
-
-def enrich_replication(state):
-    """Downloads replication archive for a given state, and creates an enriched osc.gz."""
-    response = urllib2.urlopen(get_replication_url(state, 'minute'))
-    data = response.read()
-    gz = gzip.GzipFile(fileobj=StringIO(data))
-    filename = get_replication_target_path(state)
+def find_sequence(granularity, timestamp, last):
+    """Returns the last sequence with a timestamp not after the given one,
+    or None if there is no such sequence. The search starts from a guess based
+    on the replication period, and narrows down the range of sequences, since
+    replication sometimes skips a period."""
+    if last[1] <= timestamp:
+        return last[0]
+    period = PERIODS[granularity]
+    lo, lo_ts, hi = None, None, last[0]
+    seq = last[0] - max(1, int((last[1] - timestamp).total_seconds() // period))
+    while True:
+        seq = max(seq, 0 if lo is None else lo + 1)
+        ts = download_replication_state(granularity, seq)[1]
+        if ts <= timestamp:
+            lo, lo_ts = seq, ts
+        else:
+            hi = seq
+            if seq == 0:
+                return None
+        if lo is not None and hi == lo + 1:
+            return lo
+        if lo is None:
+            seq -= max(1, int((ts - timestamp).total_seconds() // period))
+        else:
+            seq = min(lo + max(1, int((timestamp - lo_ts).total_seconds() // period)), hi - 1)
+
+
+def plan_replication(start, end, granularity='minute', catch_up=False):
+    """Returns a list of (granularity, sequence, minute sequence) tuples for diffs
+    that cover minutely diffs after start and up to end, each with a minute
+    sequence that ends at the same time.
+
+    A coarser diff is used only when it starts right where the previous diff
+    ended, and the next minutely diffs are processed until such a boundary.
+    With a granularity other than minute, diffs after the last complete one
+    of that granularity are left for later. In catch-up mode, the coarsest
+    diffs available are used while far enough behind."""
+    coarse = [g for g in GRANULARITIES[GRANULARITIES.index(granularity):] if g != 'minute']
+    if not catch_up:
+        coarse = [g for g in coarse if g == granularity]
+    if not coarse:
+        return [('minute', seq, seq) for seq in range(start + 1, end + 1)]
+    last = dict((g, download_replication_state(g)) for g in coarse)
+    last_minute = download_replication_state('minute', end)
+    plan = []
+    seq = start
+    timestamp = download_replication_state('minute', seq)[1]
+    while seq < end:
+        boundary = end
+        for g in reversed(coarse):
+            cseq = find_sequence(g, timestamp, last[g])
+            if cseq is None or cseq >= last[g][0]:
+                if g == granularity:
+                    boundary = seq
+                continue
+            next_ts = download_replication_state(g, cseq + 1)[1]
+            next_seq = find_sequence('minute', next_ts, last_minute)
+            if next_ts > last_minute[1] or download_replication_state('minute', next_seq)[1] != next_ts:
+                if g == granularity:
+                    boundary = seq
+                continue
+            if download_replication_state(g, cseq)[1] == timestamp:
+                plan.append((g, cseq + 1, next_seq))
+                seq, timestamp = next_seq, next_ts
+                break
+            boundary = min(boundary, next_seq)
+        else:
+            if boundary <= seq:
+                break
+            plan.extend(('minute', s, s) for s in range(seq + 1, boundary + 1))
+            seq = boundary
+            timestamp = download_replication_state('minute', seq)[1]
+    return plan
+
+
+def open_replication(state, subdir, data=None):
+    """Returns a file object for a replication archive: prefetched data
+    if there is any, otherwise a download stream."""
+    if data is not None:
+        return StringIO(data)
+    return downloader.open(get_replication_url(state, subdir), spool=True)
+
+
+def replication_files(urls, prefetch=True):
+    """Generates (url, data) tuples for replication urls. Data is None
+    when the files are not prefetched, so they will be streamed."""
+    if prefetch:
+        return downloader.prefetch(urls, spool=True)
+    return ((url, None) for url in urls)
+
+
+def process_replication_changesets(state, data=None):
+    """Parses replication archive for a given state while it is downloaded,
+    unless it was prefetched, and stores changeset xml strings in the cache."""
+    source = open_replication(state, 'changesets', data)
+    gz = ThreadedGunzipReader(source)
+    changesets = {}
+    try:
+        for event, element in etree.iterparse(gz):
+            if element.tag == 'changeset':
+                changesets[int(element.get('id'))] = etree.tostring(element)
+                element.clear()
+    finally:
+        gz.close()
+        source.close()
+    changeset_cache.put_many(changesets)
+
+
+@metrics.timed('api.changesets')
+def fetch_changesets_from_api(changesets):
+    """Downloads changesets in batches, and returns a dict of xml strings."""
+    changesets = sorted(changesets)
+    urls = ['{0}/changesets?changesets={1}'.format(
+        API_BASE_URL, ','.join(str(x) for x in changesets[i:i + API_CHANGESETS_LIMIT]))
+        for i in range(0, len(changesets), API_CHANGESETS_LIMIT)]
+    result = {}
+    for url, data in downloader.prefetch(urls):
+        for element in etree.fromstring(data).iterchildren('changeset'):
+            result[int(element.get('id'))] = etree.tostring(element)
+    metrics.add('api.requests', len(urls))
+    metrics.add('api.changesets', len(result))
+    return result
+
+
+@metrics.timed('changesets.fetch')
+def fetch_changesets(changesets):
+    """Returns a dict of xml strings for changesets. Those missing in the cache
+    are downloaded from the API and stored, so they are not fetched again."""
+    changesets = list(changesets)
+    result = changeset_cache.get_many(changesets)
+    missing = set(changesets) - set(result)
+    if missing:
+        fetched = fetch_changesets_from_api(missing)
+        changeset_cache.put_many(fetched)
+        result.update(fetched)
+    return result
+
+
+class ChangesetResolver(object):
+    """Looks up changesets lazily, while the diff is being decompressed. On a miss,
+    fetches all changesets the reader has found so far in one go."""
+
+    def __init__(self, reader):
+        self.reader = reader
+        self.changesets = {}
+        self.requested = set()
+
+    def get(self, changeset):
+        if changeset not in self.requested:
+            ids = set(int(x) for x in self.reader.found())
+            ids.add(changeset)
+            ids -= self.requested
+            self.changesets.update(fetch_changesets(ids))
+            self.requested.update(ids)
+        return self.changesets.get(changeset)
+
+
+def write_elements(out, items, changesets, printed_changesets):
+    """Writes (action, element) tuples, each preceded by its changeset
+    when it is seen for the first time."""
+    for action, element in items:
+        changeset = int(element.get('changeset'))
+        if changeset not in printed_changesets:
+            xml = changesets.get(changeset)
+            if xml is not None:
+                out.write_changeset(xml)
+            printed_changesets.add(changeset)
+        out.write(action, element)
+
+
+def open_target(state, granularity, compresslevel=COMPRESS_LEVEL, threads=0):
+    filename = get_replication_target_path(state, granularity)
     if not os.path.exists(os.path.dirname(filename)):
         os.makedirs(os.path.dirname(filename))
-    gzout = gzip.GzipFile(filename, 'wb')
-    gzout.write("""<?xml version="1.0" encoding="utf-8"?>\n<osmChange version="0.6" generator="Changechange">\n""")
+    return OscWriter(filename, compresslevel, threads)
+
+
+def enrich_replication(state, data=None, compresslevel=COMPRESS_LEVEL, threads=0, granularity='minute'):
+    """Parses replication archive for a given state while it is downloaded,
+    unless it was prefetched, and creates an enriched osc.gz."""
+    source = open_replication(state, granularity, data)
+    reader = ThreadedGunzipReader(source, scan=CHANGESET_RE)
+    changesets = ChangesetResolver(reader)
     action = None
     printed_changesets = set()
-    for event, element in etree.iterparse(gz, events=('start', 'end')):
-        if element.tag in ('create', 'modify', 'delete') and event == 'start':
-            action = element.tag
-        elif element.tag in ('node', 'way', 'relation') and event == 'end':
-            el_id = int(element.get('id'))
-            if element.tag == 'relation':
-                el_id = -el_id
-            # Print changeset if needed
-            changeset = int(element.get('changeset'))
-            if changeset not in printed_changesets:
-                try:
-                    chdata = db.Changeset.get(db.Changeset.changeset == changeset).xml
-                except db.Changeset.DoesNotExist:
-                    chdata = fetch_changeset_from_api(changeset)
-                gzout.write(chdata)
-                printed_changesets.add(changeset)
-
-            # Add and/or record geometry
-            if element.tag == 'node':
-                if element.get('lat'):
-                    changelib.store_node_coords(el_id, float(element.get('lat')), float(element.get('lon')))
-            elif element.tag == 'way':
-                if action == 'delete' and not element.find('nd'):
-                    # Add nodes to deleted ways, so their geometry is not empty
-                    for n in changelib.fetch_way_nodes(el_id):
-                        ndel = etree.Element('nd')
-                        ndel.set('ref', str(n))
-                        element.append(ndel)
-                nodes = []
-                for nd in element.findall('nd'):
-                    ref = int(nd.get('ref'))
-                    nodes.append(ref)
-                    node_data = changelib.fetch_node_tuple(ref)
-                    if node_data is not None and node_data[0] is not None and node_data[1] is not None:
-                        # We leave the possibility of an absent node
-                        nd.set('lat', str(node_data[0]))
-                        nd.set('lon', str(node_data[1]))
-                if action != 'delete':
-                    changelib.update_way_nodes(el_id, nodes)
-                else:
-                    changelib.delete_wr(el_id)
-            elif element.tag == 'relation':
-                # We are not adding members to deleted relations, since we don't know their roles
-                members = []
-                for member in element.findall('member'):
-                    members.append(member.get('type')[0] + member.get('ref'))
-                    ref = int(member.get('ref'))
-                    if member.get('type') == 'node':
-                        node_data = changelib.fetch_node_tuple(ref)
-                        if node_data is not None and node_data[0] is not None and node_data[1] is not None:
-                            member.set('lat', str(node_data[0]))
-                            member.set('lon', str(node_data[1]))
-                    elif member.get('type') == 'way':
-                        bbox = changelib.fetch_way_bbox(ref)
-                        if bbox is not None:
-                            member.set('minlat', str(bbox[0]))
-                            member.set('minlon', str(bbox[1]))
-                            member.set('maxlat', str(bbox[2]))
-                            member.set('maxlon', str(bbox[3]))
-                if action != 'delete':
-                    changelib.update_relation_members(el_id, members)
+    chunk = []
+    changelib.begin_diff()
+    with open_target(state, granularity, compresslevel, threads) as out:
+        try:
+            for event, element in etree.iterparse(reader, events=('start', 'end')):
+                if element.tag in ('create', 'modify', 'delete') and event == 'start':
+                    action = element.tag
+                elif element.tag in TAGS and event == 'end':
+                    # Elements of the same type are enriched in chunks
+                    if chunk and (chunk[-1][1].tag != element.tag or len(chunk) >= CHUNK_SIZE):
+                        pipeline.process(chunk)
+                        write_elements(out, chunk, changesets, printed_changesets)
+                        # Forget written elements
+                        for action_, el in chunk:
+                            el.clear()
+                            el.getparent().remove(el)
+                        chunk = []
+                    chunk.append((action, element))
+        finally:
+            reader.close()
+            source.close()
+        pipeline.process(chunk)
+        write_elements(out, chunk, changesets, printed_changesets)
+    changelib.end_diff()
+
+
+def merge_replication(states, files):
+    """Reads minutely diffs into memory and returns a list of (index, action, element)
+    tuples with the last version of each object, in the order of diffs, and a set
+    of changeset ids. Created objects stay created, and the ones both created
+    and deleted are dropped."""
+    latest = {}
+    changesets = set()
+    counter = count()
+    for index, (state, data) in enumerate(izip(states, files)):
+        source = open_replication(state, 'minute', data)
+        reader = ThreadedGunzipReader(source, scan=CHANGESET_RE)
+        action = None
+        try:
+            for event, element in etree.iterparse(reader, events=('start', 'end')):
+                if element.tag in ('create', 'modify', 'delete') and event == 'start':
+                    action = element.tag
+                elif element.tag in TAGS and event == 'end':
+                    key = (element.tag, element.get('id'))
+                    el_action = action
+                    if key in latest and latest[key][2] == 'create':
+                        el_action = None if action == 'delete' else 'create'
+                    latest[key] = (index, next(counter), el_action, element)
+                    element.getparent().remove(element)
+        finally:
+            reader.close()
+            source.close()
+        changesets.update(int(x) for x in reader.found())
+    merged = sorted(v for v in latest.itervalues() if v[2] is not None)
+    return [(index, action, element) for index, pos, action, element in merged], changesets
+
+
+def enrich_batch(states, files, compresslevel=COMPRESS_LEVEL, threads=0, merge=False):
+    """Enriches several consecutive minutely diffs in one pass, processing
+    only the last version of each object. Writes an enriched osc.gz for each
+    diff with objects last changed in it, or with merge=True, a single file
+    named after the last diff in the batch subdirectory."""
+    objects, changeset_ids = merge_replication(states, files)
+    changesets = fetch_changesets(changeset_ids)
+    changelib.begin_diff()
+    # References are taken after all changes, so they are correct for the whole batch
+    pipeline.process([(action, element) for index, action, element in objects])
+    changelib.end_diff()
+
+    out = None
+    try:
+        for i, state in enumerate(states):
+            if out is None:
+                out = open_target(states[-1] if merge else state, 'batch' if merge else 'minute',
+                                  compresslevel, threads)
+                printed_changesets = set()
+            write_elements(out, [(action, element) for index, action, element in objects if index == i],
+                           changesets, printed_changesets)
+            if not merge:
+                out.close()
+                out = None
+        if out is not None:
+            out.close()
+    except:
+        if out is not None:
+            out.discard()
+        raise
+
+
+def batch_plan(steps, size):
+    """Groups consecutive minutely steps into lists of at most size items."""
+    batch = []
+    for step in steps:
+        if batch and (len(batch) >= size or step[0][0] != 'minute' or batch[-1][0][0] != 'minute'):
+            yield batch
+            batch = []
+        batch.append(step)
+    if batch:
+        yield batch
+
+def delete_old_changesets():
+    changeset_cache.expire()
+
+
+def import_changesets_table():
+    """Moves recent changesets from the database table used before
+    the changeset cache, and drops the table."""
+    tooold = datetime.datetime.now() - datetime.timedelta(days=CHANGESET_DAYS)
+    query = db.Changeset.select(db.Changeset.changeset, db.Changeset.xml).where(
+        db.Changeset.timestamp >= tooold).tuples()
+    changesets = {}
+    for ch, xml in query.iterator():
+        changesets[ch] = xml.encode('utf-8') if isinstance(xml, unicode) else xml
+        if len(changesets) >= DB_QUERY_LIMIT:
+            changeset_cache.put_many(changesets)
+            changesets = {}
+    changeset_cache.put_many(changesets)
+    db.Changeset.drop_table()
+
+
+def process_changesets(state, cur_state, options):
+    """Stores changesets from the replication up to the current state."""
+    sys.stdout.write('Downloading changesets')
+    sequences = range(state[1] + 1, cur_state[1] + 1)
+    files = replication_files([get_replication_url(seq, 'changesets') for seq in sequences], options.prefetch > 0)
+    processed = []
+    with db.database.atomic():
+        for seq, (url, data) in izip(sequences, files):
+            sys.stdout.write('.')
+            sys.stdout.flush()
+            try:
+                process_replication_changesets(seq, data)
+            except Exception:
+                # A damaged file would fail again, so it is downloaded anew
+                downloader.discard(url)
+                raise
+            write_last_state([state[0], seq])
+            processed.append(url)
+    if processed:
+        state[1] = sequences[len(processed) - 1]
+    for url in processed:
+        downloader.discard(url)
+    print
+
+
+def process_diffs(state, cur_state, options):
+    """Enriches replication diffs up to the current state, committing
+    the state after each one. Returns the number of processed diffs."""
+    plan = plan_replication(state[0], cur_state[0] - 1, options.granularity, options.catch_up)
+    files = replication_files([get_replication_url(seq, g) for g, seq, minute_seq in plan], options.prefetch > 0)
+    count = 0
+    for batch in batch_plan(izip(plan, files), max(1, options.batch)):
+        if stop_requested:
+            break
+        metrics.begin()
+        try:
+            with db.database.atomic():
+                (granularity, seq, minute_seq), (url, data) = batch[-1]
+                if len(batch) == 1:
+                    print seq if granularity == 'minute' else '{0} {1}'.format(granularity, seq)
+                    enrich_replication(seq, data, options.compress_level, options.compress_threads, granularity)
                 else:
-                    changelib.delete_wr(el_id)
-
-            # Add referencing objects
-            if element.tag == 'node':
-                refs = changelib.fetch_node_refs(el_id)
-            else:
-                refs = changelib.fetch_wr_refs(el_id)
-            for ref in refs:
-                refel = etree.Element('ref')
-                refel.set('type', 'way' if ref > 0 else 'relation')
-                refel.set('ref', str(ref))
-                element.append(refel)
-            # Print and forget
-            p = etree.Element(action)
-            p.append(element)
-            gzout.write(etree.tostring(p, encoding='utf-8'))
-            element.clear()
-            p.clear()
-    changelib.purge_node_cache()
-    changelib.flush()
+                    print '{0}-{1}'.format(batch[0][0][1], seq)
+                    enrich_batch([step[1] for step, f in batch], [f[1] for step, f in batch],
+                                 options.compress_level, options.compress_threads, options.batch_merge)
+                # The state is always kept as a minutely sequence
+                write_last_state([minute_seq, state[1]])
+                changelib.write_journal(minute_seq)
+        except Exception:
+            changelib.abort_diff()
+            # A damaged file would fail again, so it is downloaded anew
+            for step, (url, data) in batch:
+                downloader.discard(url)
+            raise
+        except:
+            changelib.abort_diff()
+            raise
+        # After a crash from here, the journal is replayed on start
+        changelib.apply_journal()
+        state[0] = minute_seq
+        prune_replication_states(minute_seq)
+        count += len(batch)
+        if options.metrics:
+            record = metrics.end(sequence=seq, granularity=granularity, diffs=len(batch))
+            metrics.write(record, options.metrics, options.metrics_format)
+        for step, (url, data) in batch:
+            downloader.discard(url)
+    return count
+
+
+def print_cache_stats():
+    for name, st in sorted(cache_stats().items()):
+        print '{0} cache: {1} of {2} entries, {3} hits, {4} misses, {5} evictions'.format(
+            name.capitalize(), st['size'], st['max_size'], st['hits'], st['misses'], st['evictions'])
+
+
+def request_stop(signum, frame):
+    global stop_requested
+    stop_requested = True
+
+
+def run_daemon(state, options):
+    """Polls replication state and processes new diffs as they appear, keeping
+    the database, binary files and caches open. Waits longer after each poll
+    without new data or with an error, up to max_interval seconds."""
+    interval = options.poll_interval
+    last_cleanup = time.time()
+    while not stop_requested:
+        processed = 0
+        try:
+            cur_state = download_last_state()
+            if time.time() - last_cleanup > CHANGESET_CLEANUP_INTERVAL:
+                delete_old_changesets()
+                last_cleanup = time.time()
+            if cur_state[1] > state[1]:
+                process_changesets(state, cur_state, options)
+            processed = process_diffs(state, cur_state, options)
+        except Exception as e:
+            print 'Failed to process replication:', e
+        if processed:
+            interval = options.poll_interval
+        elif not stop_requested:
+            time.sleep(interval)
+            interval = min(interval * 2, options.max_interval)
+
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Enriches OSM replication diffs with geometry and references.')
+    parser.add_argument('path', nargs='?', help='Directory with the database and binary files')
+    parser.add_argument('--replication-url', default=REPLICATION_BASE_URL, help='Replication base URL')
+    parser.add_argument('--api-url', default=API_BASE_URL, help='OSM API base URL')
+    parser.add_argument('--granularity', choices=GRANULARITIES, default='minute',
+                        help='Replication diffs to process')
+    parser.add_argument('--catch-up', action='store_true',
+                        help='Process coarser diffs while far behind')
+    parser.add_argument('--no-bbox', action='store_true', help='Do not add bboxes to relations and their members')
+    parser.add_argument('--no-refs', action='store_true', help='Do not add referencing ways and relations')
+    parser.add_argument('--batch', type=int, default=1,
+                        help='Number of minutely diffs to enrich in one pass')
+    parser.add_argument('--batch-merge', action='store_true',
+                        help='Write one file for a batch, instead of one for each diff')
+    parser.add_argument('--workers', type=int, default=4, help='Number of parallel downloads')
+    parser.add_argument('--prefetch', type=int, default=16,
+                        help='Number of files to download in advance, 0 to parse files while downloading')
+    parser.add_argument('--spool', help='Directory to keep downloaded files in until they are processed')
+    parser.add_argument('--compress-level', type=int, default=COMPRESS_LEVEL, help='Gzip level for output files')
+    parser.add_argument('--compress-threads', type=int, default=0,
+                        help='Number of threads compressing output files, 0 to compress inline')
+    parser.add_argument('--metrics', help='File to write metrics for each diff to')
+    parser.add_argument('--metrics-format', choices=('json', 'prometheus'), default='json',
+                        help='Metrics format: JSON lines appended to the file, or a Prometheus textfile')
+    parser.add_argument('--daemon', action='store_true',
+                        help='Keep running and process new diffs as they appear')
+    parser.add_argument('--poll-interval', type=float, default=POLL_INTERVAL,
+                        help='Seconds between checks for new diffs in the daemon mode')
+    parser.add_argument('--max-interval', type=float, default=MAX_POLL_INTERVAL,
+                        help='Longest wait between checks, after failures or no new data')
+    parser.add_argument('--sqlite-profile', choices=sorted(db.SQLITE_PROFILES), default='performance',
+                        help='Set of SQLite pragmas')
+    parser.add_argument('--backend', choices=sorted(changelib.BACKENDS),
+                        help='Store for reference lists: SQLite with prepared statements or peewee queries, '
+                        'or key-value files made by migrate.py. Detected by default')
+    parser.add_argument('--node-cache', type=int, default=changelib.NODE_CACHE_MEMORY,
+                        help='Node cache size in megabytes')
+    parser.add_argument('--bbox-cache', type=int, default=changelib.BBOX_CACHE_MEMORY,
+                        help='Way bbox cache size in megabytes')
+    parser.add_argument('--no-journal', action='store_true',
+                        help='Write binary files directly, which is faster, but after a crash '
+                        'they can be out of sync with the database')
+    parser.add_argument('--changeset-partition', choices=sorted(PARTITIONS), default='day',
+                        help='Period of changeset cache files, which are deleted when expired')
+    options = parser.parse_args()
+    path = options.path if options.path and os.path.exists(options.path) else os.path.dirname(sys.argv[0])
+    REPLICATION_BASE_URL = options.replication_url.rstrip('/')
+    API_BASE_URL = options.api_url.rstrip('/')
+    downloader = Downloader(options.workers, options.prefetch, spool=options.spool)
+    pipeline = Pipeline(bbox=not options.no_bbox, refs=not options.no_refs)
+    changelib.set_cache_memory(options.node_cache, options.bbox_cache)
+
     try:
         cur_state = download_last_state()
     except Exception as e:
@@ -183,34 +604,48 @@ if __name__ == '__main__':
 
     db.database.init(os.path.join(path, 'changechange.db'))
     db.database.connect()
-    db.database.create_tables([db.Changeset, db.NodeRef, db.WayRelRef, db.Members, db.State], safe=True)
+    db.apply_profile(options.sqlite_profile)
+    if not options.no_journal:
+        # The journal is removed after a commit, so the commit must be on disk by then
+        db.database.execute_sql('PRAGMA synchronous = FULL', require_commit=False)
+    db.database.create_tables([db.NodeRef, db.WayRelRef, db.Members, db.State], safe=True)
+    changeset_cache = ChangesetCache(os.path.join(path, 'changesets'), options.changeset_partition,
+                                     CHANGESET_DAYS * 86400)
+    if db.Changeset.table_exists():
+        print 'Moving changesets to the cache'
+        import_changesets_table()
 
     state = read_last_state()
     if state is None:
         state = [x-1 for x in cur_state]
 
-    # Delete old changesets
-    tooold = datetime.datetime.now() - datetime.timedelta(days=2)
-    query = db.Changeset.delete().where(db.Changeset.timestamp < tooold)
-    query.execute()
-
-    # Process changeset replication
-    sys.stdout.write('Downloading changesets')
-    with db.database.atomic():
-        while state[1] < cur_state[1]:
-            sys.stdout.write('.')
-            sys.stdout.flush()
-            state[1] += 1
-            process_replication_changesets(state[1])
-            write_last_state(state)
-    print
+    delete_old_changesets()
+    process_changesets(state, cur_state, options)
 
-    # Process data replication
-    changelib.open(path)
-    while state[0] < cur_state[0] - 1:
-        with db.database.atomic():
-            state[0] += 1
-            print state[0]
-            enrich_replication(state[0])
-            write_last_state(state)
+    # The flag file stays if calculating relation bboxes is interrupted
+    rebuild_flag = os.path.join(path, 'relations.bin.rebuild')
+    if not os.path.exists(os.path.join(path, 'relations.bin')):
+        open(rebuild_flag, 'w').close()
+    changelib.open(path, store=options.backend, journal=not options.no_journal)
+    recovered = changelib.recover(state[0])
+    if recovered is not None:
+        if recovered[1]:
+            print 'Replayed the journal for', recovered[0]
+        else:
+            print 'Dropped changes of an unfinished diff', recovered[0] or ''
+    if os.path.exists(rebuild_flag):
+        print 'Calculating relation bboxes'
+        changelib.rebuild_relation_bboxes()
+        changelib.flush()
+        os.remove(rebuild_flag)
+    metrics.add_probe(collect_stats)
+    if options.daemon:
+        # Finish the current diff before exiting
+        signal.signal(signal.SIGTERM, request_stop)
+        signal.signal(signal.SIGINT, request_stop)
+        run_daemon(state, options)
+    else:
+        process_diffs(state, cur_state, options)
     changelib.close()
+    changeset_cache.close()
+    print_cache_stats()
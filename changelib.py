@@ -1,35 +1,168 @@
-from bigmmap import BigMMap
-from db import NodeRef, WayRelRef, Members
+import sys
+import numpy as np
+from collections import deque, Counter
+from bigmmap import BigMMap, MODE_PAGED, MODE_WHOLE, MADV_RANDOM
+from refstore import BaseRefStore, RefStore, SqlRefStore, WriteBackRefStore, encode_member, decode_member
+from kvstore import KVRefStore
+from journal import Journal
+from lrucache import LRUCache
+import metrics
 from os.path import join
 
 CACHE = True
 COORD_MULTIPLIER = 1e7
 node_mmap = None
 bbox_mmap = None
-
-NODE_CACHE_MAX_SIZE = 100000
-node_cache = {}
-last_nodes = []
-
-BBOX_CACHE_MAX_SIZE = 10000
-bbox_cache = {}
-last_bboxes = []
-
-
-def open(path):
-    global node_mmap, bbox_mmap
-    node_mmap = BigMMap(join(path, 'nodes.bin'))
-    bbox_mmap = BigMMap(join(path, 'ways.bin'))
+rel_bbox_mmap = None
+journal = None
+JOURNAL_FILE = 'journal.bin'
+# Whether changes in diffs go through the journal
+use_journal = False
+db_store = SqlRefStore()
+ref_store = db_store
+# Ways with moved nodes, which bboxes are updated at the end of a diff
+dirty_ways = None
+# Relations which bboxes are recalculated at the end of a diff,
+# and ways with changed bboxes, which parents are added to them
+dirty_relations = None
+moved_ways = None
+# A relation bbox is recalculated at most this many times in a round,
+# so changes do not go around cycles of relations forever
+RELATION_BBOX_PASSES = 8
+# Ways with fewer nodes are faster to read value by value than with numpy
+MIN_BBOX_BATCH = 12
+# Mapping whole files is only possible with a 64-bit address space
+DEFAULT_MMAP_MODE = MODE_WHOLE if sys.maxsize > 2 ** 32 else MODE_PAGED
+
+# Cache sizes are in megabytes, entry sizes are estimates in bytes
+# for an OrderedDict entry with a tuple or a list of floats
+NODE_CACHE_MEMORY = 32
+NODE_ENTRY_SIZE = 300
+node_cache = LRUCache.for_memory(NODE_CACHE_MEMORY, NODE_ENTRY_SIZE)
+
+# Stores for reference lists, constructed with a data directory and a mapping mode
+BACKENDS = {
+    'sqlite': lambda path, mode: SqlRefStore(),
+    'orm': lambda path, mode: RefStore(),
+    'kv': KVRefStore,
+}
+
+BBOX_CACHE_MEMORY = 4
+BBOX_ENTRY_SIZE = 400
+bbox_cache = LRUCache.for_memory(BBOX_CACHE_MEMORY, BBOX_ENTRY_SIZE)
+
+
+def detect_backend(path):
+    """Returns 'kv' if the directory has key-value files, otherwise 'sqlite'."""
+    return 'kv' if KVRefStore.exists(path) else 'sqlite'
+
+
+def open(path, node_mode=None, bbox_mode=None, store=None, journal=False):
+    """Opens binary files. Modes are either MODE_WHOLE or MODE_PAGED,
+    by default DEFAULT_MMAP_MODE is used. The store for reference lists
+    is a name from BACKENDS or a BaseRefStore, detected by default.
+    With journal=True, changes in diffs are journaled, see open_journal().
+    A journal left after a crash is handled by recover() either way."""
+    global node_mmap, bbox_mmap, rel_bbox_mmap, db_store, ref_store
+    if not isinstance(store, BaseRefStore):
+        store = BACKENDS[store or detect_backend(path)](path, DEFAULT_MMAP_MODE)
+    db_store = ref_store = store
+    node_mmap = BigMMap(join(path, 'nodes.bin'), mode=node_mode or DEFAULT_MMAP_MODE, advice=MADV_RANDOM)
+    bbox_mmap = BigMMap(join(path, 'ways.bin'), mode=bbox_mode or DEFAULT_MMAP_MODE, advice=MADV_RANDOM)
+    rel_bbox_mmap = BigMMap(join(path, 'relations.bin'), mode=bbox_mode or DEFAULT_MMAP_MODE, advice=MADV_RANDOM)
+    open_journal(path, journal)
+
+
+def open_journal(path, enabled=True):
+    """Keeps writes to binary files in memory during a diff. They are saved
+    to a journal by write_journal(sequence) before the sequence is committed,
+    and written to files by apply_journal() after that. Call recover()
+    before any changes."""
+    global journal, use_journal
+    mmaps = {'nodes': node_mmap, 'ways': bbox_mmap, 'relations': rel_bbox_mmap}
+    mmaps.update(db_store.mmaps())
+    journal = Journal(join(path, JOURNAL_FILE), mmaps)
+    use_journal = enabled
+
+
+def recover(committed):
+    """Replays or drops a journal left after a crash, depending on the committed
+    sequence. Returns the journal sequence and whether it was replayed, or None."""
+    result = journal.recover(committed)
+    if result is not None:
+        node_cache.clear()
+        bbox_cache.clear()
+    return result
+
+
+def begin_diff():
+    """Starts collecting changes: reference lists are kept in memory,
+    and way and relation bboxes are recalculated once in end_diff()."""
+    global ref_store, dirty_ways, dirty_relations, moved_ways
+    ref_store = WriteBackRefStore(db_store)
+    dirty_ways = set()
+    dirty_relations = set()
+    moved_ways = set()
+    if use_journal:
+        journal.begin()
+
+
+@metrics.timed('changelib.end_diff')
+def end_diff():
+    """Updates bboxes for ways with moved nodes and for affected relations,
+    and writes all changed reference lists to the database. Should be called
+    in a transaction."""
+    global ref_store, dirty_ways, dirty_relations, moved_ways
+    update_bboxes()
+    dirty_ways = dirty_relations = moved_ways = None
+    ref_store.flush()
+    ref_store = db_store
+    flush()
+
+
+def abort_diff():
+    """Drops collected changes after a failed diff, the transaction
+    should be rolled back."""
+    global ref_store, dirty_ways, dirty_relations, moved_ways
+    ref_store = db_store
+    dirty_ways = dirty_relations = moved_ways = None
+    if use_journal:
+        journal.discard()
+        # Cached values could come from dropped changes
+        node_cache.clear()
+        bbox_cache.clear()
+
+
+def write_journal(sequence):
+    """Saves changes of a finished diff to the journal. Should be called
+    in the transaction that commits the sequence."""
+    if use_journal:
+        # Key-value logs must be on disk before indexes point to them
+        db_store.flush()
+        journal.write(sequence)
+
+
+def apply_journal():
+    """Writes journaled changes to binary files, after the sequence is committed."""
+    if use_journal:
+        journal.apply()
 
 
 def flush():
     node_mmap.flush()
     bbox_mmap.flush()
+    rel_bbox_mmap.flush()
+    db_store.flush()
 
 
 def close():
+    global journal, use_journal
+    journal = None
+    use_journal = False
     node_mmap.close()
     bbox_mmap.close()
+    rel_bbox_mmap.close()
+    db_store.close()
 
 
 def coord_to_int32(coord):
@@ -40,19 +173,23 @@ def int32_to_coord(value):
     return None if value is None else float(value) / COORD_MULTIPLIER
 
 
-def split_comma(s):
-    if len(s) == 0:
-        return []
-    return s.split(',')
+def set_cache_memory(node_megabytes, bbox_megabytes):
+    """Replaces node and bbox caches with empty ones of given sizes."""
+    global node_cache, bbox_cache
+    node_cache = LRUCache.for_memory(node_megabytes, NODE_ENTRY_SIZE)
+    bbox_cache = LRUCache.for_memory(bbox_megabytes, BBOX_ENTRY_SIZE)
 
 
-def split_comma_i(s):
-    return [int(x) for x in split_comma(s)]
+def cache_stats():
+    """Returns a dict of hit, miss and eviction counters for both caches."""
+    return {'node': node_cache.stats(), 'bbox': bbox_cache.stats()}
 
 
 def fetch_node_tuple(node_id):
-    if CACHE and node_id in node_cache:
-        return node_cache[node_id]
+    if CACHE:
+        t = node_cache.get(node_id)
+        if t is not None:
+            return t
     base = node_id * 3
     lat = int32_to_coord(node_mmap[base])
     lon = int32_to_coord(node_mmap[base + 1])
@@ -60,16 +197,37 @@ def fetch_node_tuple(node_id):
     t = (lat, lon, ref)
     if CACHE:
         node_cache[node_id] = t
-    last_nodes.append(node_id)
     return t
 
 
+@metrics.timed('changelib.fetch_node_tuples')
+def fetch_node_tuples(node_ids):
+    """Same as fetch_node_tuple, but for a list of nodes, reading missing ones in a batch."""
+    result = [node_cache.get(n) for n in node_ids] if CACHE else [None] * len(node_ids)
+    missing = [i for i, t in enumerate(result) if t is None]
+    if missing:
+        records = node_mmap.get_records([node_ids[i] for i in missing], 3).tolist()
+        for i, rec in zip(missing, records):
+            t = (int32_to_coord(rec[0]), int32_to_coord(rec[1]), rec[2])
+            result[i] = t
+            if CACHE:
+                node_cache[node_ids[i]] = t
+    return result
+
+
 def store_node_coords_fast(node_id, lat, lon):
     base = node_id * 3
     node_mmap[base] = coord_to_int32(lat)
     node_mmap[base + 1] = coord_to_int32(lon)
 
 
+def store_node_coords_many(node_ids, lats, lons):
+    """Same as store_node_coords_fast for arrays of nodes and coordinates."""
+    base = np.asarray(node_ids, dtype=np.int64) * 3
+    coords = np.round(np.concatenate((lats, lons)) * COORD_MULTIPLIER).astype(np.int64)
+    node_mmap.set_many(np.concatenate((base, base + 1)), coords)
+
+
 def store_node_coords(node_id, lat, lon):
     t = fetch_node_tuple(node_id)
     if lat == t[0] and lon == t[1]:
@@ -80,34 +238,211 @@ def store_node_coords(node_id, lat, lon):
     base = node_id * 3
     node_mmap[base] = coord_to_int32(lat)
     node_mmap[base + 1] = coord_to_int32(lon)
-    for ref in fetch_node_refs(node_id):
+    refs = fetch_node_refs(node_id)
+    for ref in refs:
         if ref > 0:
-            update_way_bbox(ref)
+            if dirty_ways is not None:
+                dirty_ways.add(ref)
+            else:
+                update_way_bbox(ref)
+    mark_relations([ref for ref in refs if ref < 0])
+
+
+@metrics.timed('changelib.store_node_coords_batch')
+def store_node_coords_batch(node_ids, lats, lons):
+    """Same as store_node_coords for lists of nodes, reading them and their references in a batch."""
+    moved = []
+    # Tuples written in this batch, since a node can have several versions in a diff
+    written = {}
+    for node_id, lat, lon, t in zip(node_ids, lats, lons, fetch_node_tuples(node_ids)):
+        t = written.get(node_id, t)
+        if lat == t[0] and lon == t[1]:
+            continue
+        if node_id not in written:
+            moved.append(node_id)
+        written[node_id] = (lat, lon, t[2])
+        if CACHE:
+            node_cache[node_id] = written[node_id]
+        base = node_id * 3
+        node_mmap[base] = coord_to_int32(lat)
+        node_mmap[base + 1] = coord_to_int32(lon)
+    for refs in fetch_node_refs_many(moved):
+        for ref in refs:
+            if ref > 0:
+                if dirty_ways is not None:
+                    dirty_ways.add(ref)
+                else:
+                    update_way_bbox(ref)
+        mark_relations([ref for ref in refs if ref < 0])
 
 
 def fetch_way_bbox(way_id):
-    if CACHE and way_id in bbox_cache:
-        return bbox_cache[way_id]
+    if dirty_ways and way_id in dirty_ways:
+        dirty_ways.remove(way_id)
+        update_way_bbox(way_id)
+    if CACHE:
+        bbox = bbox_cache.get(way_id)
+        if bbox is not None:
+            return bbox
     base = way_id * 4
     bbox = [int32_to_coord(bbox_mmap[base + x]) for x in range(4)]
     if bbox[0] is None or bbox[1] is None or bbox[2] is None:
         return None
     if CACHE:
         bbox_cache[way_id] = bbox
-    last_bboxes.append(way_id)
     return bbox
 
 
+@metrics.timed('changelib.fetch_way_bboxes')
+def fetch_way_bboxes(way_ids):
+    """Same as fetch_way_bbox, but for a list of ways, reading missing ones in a batch."""
+    if dirty_ways:
+        for way_id in dirty_ways.intersection(way_ids):
+            dirty_ways.remove(way_id)
+            update_way_bbox(way_id)
+    return _read_bboxes(bbox_mmap, way_ids, way_ids)
+
+
+def _read_bbox(mm, wr_id, index):
+    """Same as _read_bboxes for a single way or relation, without numpy overhead."""
+    if CACHE:
+        bbox = bbox_cache.get(wr_id)
+        if bbox is not None:
+            return bbox
+    bbox = [int32_to_coord(mm[index * 4 + x]) for x in range(4)]
+    if bbox[0] is None or bbox[1] is None or bbox[2] is None:
+        return None
+    if CACHE:
+        bbox_cache[wr_id] = bbox
+    return bbox
+
+
+def _read_bboxes(mm, wr_ids, index):
+    """Reads bboxes for ways or relations from the cache, or at index * 4 in a file.
+    The cache is shared, with relations under negative ids."""
+    result = [bbox_cache.get(w) for w in wr_ids] if CACHE else [None] * len(wr_ids)
+    missing = [i for i, b in enumerate(result) if b is None]
+    if missing:
+        records = mm.get_records([index[i] for i in missing], 4).tolist()
+        for i, rec in zip(missing, records):
+            if rec[0] is None or rec[1] is None or rec[2] is None:
+                continue
+            bbox = [int32_to_coord(x) for x in rec]
+            result[i] = bbox
+            if CACHE:
+                bbox_cache[wr_ids[i]] = bbox
+    return result
+
+
 def store_way_bbox(way_id, bbox):
     if bbox is None:
         return
+    changed = _read_bbox(bbox_mmap, way_id, way_id) != bbox
     if CACHE:
-        if way_id not in bbox_cache:
-            last_bboxes.append(way_id)
         bbox_cache[way_id] = bbox
     base = way_id * 4
     for n in range(4):
         bbox_mmap[base + n] = coord_to_int32(bbox[n])
+    if changed:
+        if moved_ways is not None:
+            moved_ways.add(way_id)
+        else:
+            mark_relations(fetch_wr_refs(way_id))
+
+
+@metrics.timed('changelib.fetch_relation_bboxes')
+def fetch_relation_bboxes(rel_ids):
+    """Returns bboxes for relations (negative ids), None for ones without
+    members with coordinates. Pending changes in a diff are applied first."""
+    if dirty_relations is not None:
+        update_bboxes()
+    return _read_bboxes(rel_bbox_mmap, rel_ids, [-r for r in rel_ids])
+
+
+def store_relation_bbox(rel_id, bbox):
+    if CACHE:
+        if bbox is None:
+            bbox_cache.discard(rel_id)
+        else:
+            bbox_cache[rel_id] = bbox
+    base = -rel_id * 4
+    for n in range(4):
+        rel_bbox_mmap[base + n] = None if bbox is None else coord_to_int32(bbox[n])
+
+
+def mark_relations(rel_ids):
+    """Schedules bbox updates for relations with changed members,
+    or updates them at once outside of a diff."""
+    if not rel_ids:
+        return
+    if dirty_relations is not None:
+        dirty_relations.update(rel_ids)
+    else:
+        update_relation_bboxes(rel_ids)
+
+
+def update_bboxes():
+    """Recalculates bboxes of ways with moved nodes, then of relations with changed members."""
+    while dirty_ways:
+        update_way_bbox(dirty_ways.pop())
+    if moved_ways:
+        for refs in fetch_wr_refs_many(list(moved_ways)):
+            dirty_relations.update(refs)
+        moved_ways.clear()
+    if dirty_relations:
+        update_relation_bboxes(dirty_relations)
+        dirty_relations.clear()
+
+
+@metrics.timed('changelib.calc_relation_bbox')
+def calc_relation_bbox(rel_id):
+    """Unites coordinates of node members and stored bboxes of way and relation members."""
+    members = ref_store.members(rel_id)
+    types = members & 3
+    ids = members >> 2
+    boxes = [b for b in fetch_way_bboxes(ids[types == 1].tolist()) if b is not None]
+    sub_ids = ids[types == 2]
+    boxes.extend(b for b in _read_bboxes(rel_bbox_mmap, (-sub_ids).tolist(), sub_ids) if b is not None)
+    for t in fetch_node_tuples(ids[types == 0].tolist()):
+        if t[0] is not None and t[1] is not None:
+            boxes.append((t[0], t[1], t[0], t[1]))
+    if not boxes:
+        return None
+    return [min(b[0] for b in boxes), min(b[1] for b in boxes),
+            max(b[2] for b in boxes), max(b[3] for b in boxes)]
+
+
+@metrics.timed('changelib.update_relation_bboxes')
+def update_relation_bboxes(rel_ids):
+    """Recalculates bboxes of relations, and of their parents when they change.
+    Parents are queued after children, and each relation is recalculated
+    at most RELATION_BBOX_PASSES times, so cycles stop. Relations in a cycle
+    contain each other, so their bboxes can stay larger when members shrink."""
+    passes = Counter()
+    queue = deque(set(rel_ids))
+    while queue:
+        rel_id = queue.popleft()
+        if passes[rel_id] >= RELATION_BBOX_PASSES:
+            continue
+        passes[rel_id] += 1
+        bbox = calc_relation_bbox(rel_id)
+        if bbox != _read_bbox(rel_bbox_mmap, rel_id, -rel_id):
+            store_relation_bbox(rel_id, bbox)
+            queue.extend(fetch_wr_refs(rel_id))
+    metrics.add('bbox.relations', sum(passes.itervalues()))
+
+
+def rebuild_relation_bboxes(batch_size=10000):
+    """Calculates bboxes for all relations: after a bulk import,
+    or for a database made before relations.bin."""
+    batch = []
+    for key, members in db_store._items(db_store.MEMBERS):
+        if key < 0:
+            batch.append(key)
+            if len(batch) >= batch_size:
+                update_relation_bboxes(batch)
+                batch = []
+    update_relation_bboxes(batch)
 
 
 def add_node_ref(node_id, wr_id):
@@ -118,39 +453,23 @@ def add_node_ref(node_id, wr_id):
             node_cache[node_id] = t
         node_mmap[node_id * 3 + 2] = wr_id
     elif t[2] != wr_id:
-        try:
-            nr = NodeRef.get(NodeRef.node_id == node_id)
-            refs = set(split_comma_i(nr.refs))
-            if wr_id not in refs:
-                refs.add(wr_id)
-                nr.refs = ','.join([str(x) for x in refs])
-                nr.save()
-        except NodeRef.DoesNotExist:
-            nr = NodeRef()
-            nr.node_id = node_id
-            nr.refs = str(wr_id)
-            nr.save()
+        ref_store.add_node_ref(node_id, wr_id)
 
 
 def remove_node_ref(node_id, wr_id):
     t = fetch_node_tuple(node_id)
-    refs = set(fetch_node_refs(node_id))
-    if wr_id in refs:
-        refs.remove(wr_id)
-    were_refs = len(refs) > 0
     if wr_id == t[2]:
-        newval = None if len(refs) == 0 else refs.pop()
-        t = (t[0], t[1], newval)
+        # Move one of the other references into nodes.bin
+        refs = ref_store.node_refs(node_id)
+        newval = None
+        if len(refs) > 0:
+            newval = int(refs[-1])
+            ref_store.remove_node_ref(node_id, newval)
         if CACHE:
-            node_cache[node_id] = t
+            node_cache[node_id] = (t[0], t[1], newval)
         node_mmap[node_id * 3 + 2] = newval
-        if were_refs:
-            nr = NodeRef.get(NodeRef.node_id == node_id)
-            if len(refs) > 0:
-                nr.refs = ','.join([str(x) for x in refs])
-                nr.save()
-            else:
-                nr.delete_instance()
+    elif t[2] is not None:
+        ref_store.remove_node_ref(node_id, wr_id)
 
 
 def fetch_node_refs(node_id):
@@ -158,91 +477,100 @@ def fetch_node_refs(node_id):
     t = fetch_node_tuple(node_id)
     if t[2] is not None:
         refs.append(t[2])
-        try:
-            nr = NodeRef.get(NodeRef.node_id == node_id)
-            refs.extend(split_comma_i(nr.refs))
-        except NodeRef.DoesNotExist:
-            pass
+        refs.extend(ref_store.node_refs(node_id).tolist())
     return refs
 
 
+@metrics.timed('changelib.fetch_node_refs_many')
+def fetch_node_refs_many(node_ids):
+    """Same as fetch_node_refs for a list of nodes, returns a list of lists."""
+    tuples = fetch_node_tuples(node_ids)
+    stored = ref_store.node_refs_many([n for n, t in zip(node_ids, tuples) if t[2] is not None])
+    return [[] if t[2] is None else [t[2]] + stored[n].tolist() for n, t in zip(node_ids, tuples)]
+
+
 def add_wr_ref(wr_id, ref_id):
-    try:
-        wr = WayRelRef.get(WayRelRef.wr_id == wr_id)
-    except WayRelRef.DoesNotExist:
-        wr = WayRelRef()
-        wr.wr_id = wr_id
-        wr.refs = ''
-    refs = split_comma(wr.refs)
-    try:
-        refs.index(str(-ref_id))
-    except ValueError:
-        wr.refs = ','.join(refs + [str(-ref_id)])
-        wr.save()
+    ref_store.add_wr_ref(wr_id, ref_id)
 
 
 def remove_wr_ref(wr_id, ref_id):
-    try:
-        wr = WayRelRef.get(WayRelRef.wr_id == wr_id)
-        refs = split_comma(wr.refs)
-        try:
-            refs.remove(str(-ref_id))
-            wr.refs = ','.join(refs)
-            wr.save()
-        except ValueError:
-            pass
-    except WayRelRef.DoesNotExist:
-        pass
+    ref_store.remove_wr_ref(wr_id, ref_id)
 
 
 def fetch_wr_refs(wr_id):
-    try:
-        wr = WayRelRef.get(WayRelRef.wr_id == wr_id)
-        return [-int(x) for x in split_comma(wr.refs)]
-    except WayRelRef.DoesNotExist:
-        return []
+    return ref_store.wr_refs(wr_id).tolist()
+
+
+@metrics.timed('changelib.fetch_wr_refs_many')
+def fetch_wr_refs_many(wr_ids):
+    refs = ref_store.wr_refs_many(wr_ids)
+    return [refs[wr_id].tolist() for wr_id in wr_ids]
 
 
 def fetch_way_nodes(way_id):
-    try:
-        member = Members.get(Members.wr_id == way_id)
-        return split_comma_i(member.members)
-    except Members.DoesNotExist:
-        return []
+    return ref_store.members(way_id).tolist()
 
 
-def calc_bbox(nodes):
+@metrics.timed('changelib.fetch_way_nodes_many')
+def fetch_way_nodes_many(way_ids):
+    nodes = ref_store.members_many(way_ids)
+    return [nodes[way_id].tolist() for way_id in way_ids]
+
+
+def _calc_bbox_scalar(nodes):
+    """Same as calc_bbox for short ways, reading values one by one."""
     bbox = None
     for n in nodes:
-        t = fetch_node_tuple(n)
-        if t[0] is not None and t[1] is not None:
-            if bbox is None:
-                bbox = [t[0], t[1], t[0], t[1]]
-            else:
-                bbox[0] = min(bbox[0], t[0])
-                bbox[1] = min(bbox[1], t[1])
-                bbox[2] = max(bbox[0], t[0])
-                bbox[3] = max(bbox[1], t[1])
-    return bbox
+        lat = node_mmap[n * 3]
+        lon = node_mmap[n * 3 + 1]
+        if lat is None or lon is None:
+            continue
+        if bbox is None:
+            bbox = [lat, lon, lat, lon]
+            continue
+        if lat < bbox[0]:
+            bbox[0] = lat
+        elif lat > bbox[2]:
+            bbox[2] = lat
+        if lon < bbox[1]:
+            bbox[1] = lon
+        elif lon > bbox[3]:
+            bbox[3] = lon
+    return None if bbox is None else [int32_to_coord(x) for x in bbox]
+
+
+@metrics.timed('changelib.calc_bbox')
+def calc_bbox(nodes):
+    if len(nodes) == 0:
+        return None
+    # Node coordinates are written through the cache, so the mmap is up to date
+    if len(nodes) < MIN_BBOX_BATCH:
+        return _calc_bbox_scalar(nodes)
+    # Raw values are used, since a masked array has a high fixed cost
+    base = np.asarray(nodes, dtype=np.int64) * 3
+    coords = node_mmap.get_raw(np.concatenate((base, base + 1))).reshape(2, len(base))
+    coords = coords[:, (coords != 0).all(axis=0)]
+    if coords.shape[1] == 0:
+        return None
+    coords[coords == node_mmap.ZERO_VALUE] = 0
+    bmin = coords.min(axis=1)
+    bmax = coords.max(axis=1)
+    return [int32_to_coord(int(x)) for x in (bmin[0], bmin[1], bmax[0], bmax[1])]
 
 
+@metrics.timed('changelib.update_way_nodes')
 def update_way_nodes(way_id, nodes):
     # Update way members in the database
-    try:
-        way = Members.get(Members.wr_id == way_id)
-    except Members.DoesNotExist:
-        way = Members()
-        way.wr_id = way_id
-        way.members = ''
-    new_members = ','.join([str(x) for x in nodes])
-    if new_members == way.members:
+    old_nodes = ref_store.members(way_id)
+    if np.array_equal(old_nodes, nodes):
         return
-    old_nodes = set(split_comma_i(way.members))
-    way.members = new_members
-    way.save()
+    ref_store.set_members(way_id, nodes)
+    old_nodes = set(old_nodes.tolist())
     # Update stored way bbox
     bbox = calc_bbox(nodes)
     store_way_bbox(way_id, bbox)
+    if dirty_ways:
+        dirty_ways.discard(way_id)
     # Update references for nodes
     for n in nodes:
         if n not in old_nodes:
@@ -259,19 +587,15 @@ def update_way_bbox(way_id):
     store_way_bbox(way_id, bbox)
 
 
+@metrics.timed('changelib.update_relation_members')
 def update_relation_members(rel_id, members):
-    try:
-        rel = Members.get(Members.wr_id == rel_id)
-    except Members.DoesNotExist:
-        rel = Members()
-        rel.wr_id = rel_id
-        rel.members = ''
-    new_members = ','.join(members)
-    if new_members == rel.members:
+    new_members = [encode_member(m) for m in members]
+    old_members = ref_store.members(rel_id)
+    if np.array_equal(old_members, new_members):
         return
-    old_members = set(split_comma(rel.members))
-    rel.members = new_members
-    rel.save()
+    ref_store.set_members(rel_id, new_members)
+    mark_relations([rel_id])
+    old_members = set(decode_member(m) for m in old_members.tolist())
     # Update references for individual objects
     for m in members:
         typ = m[0]
@@ -279,7 +603,7 @@ def update_relation_members(rel_id, members):
         if typ == 'n':
             add_node_ref(ref, rel_id)
         else:
-            add_wr_ref(ref, rel_id)
+            add_wr_ref(ref if typ == 'w' else -ref, rel_id)
         try:
             old_members.remove(m)
         except KeyError:
@@ -290,7 +614,7 @@ def update_relation_members(rel_id, members):
         if typ == 'n':
             remove_node_ref(ref, rel_id)
         else:
-            remove_wr_ref(ref, rel_id)
+            remove_wr_ref(ref if typ == 'w' else -ref, rel_id)
 
 
 def delete_wr(wr_id):
@@ -298,15 +622,3 @@ def delete_wr(wr_id):
         update_way_nodes(wr_id, [])
     else:
         update_relation_members(wr_id, [])
-
-
-def purge_node_cache():
-    global last_nodes, last_bboxes
-    if len(last_nodes) > NODE_CACHE_MAX_SIZE:
-        for i in range(0, len(last_nodes) - NODE_CACHE_MAX_SIZE):
-            del node_cache[last_nodes[i]]
-        last_nodes = last_nodes[len(last_nodes) - NODE_CACHE_MAX_SIZE:]
-    if len(last_bboxes) > BBOX_CACHE_MAX_SIZE:
-        for i in range(0, len(last_bboxes) - BBOX_CACHE_MAX_SIZE):
-            del bbox_cache[last_bboxes[i]]
-        last_bboxes = last_bboxes[len(last_bboxes) - BBOX_CACHE_MAX_SIZE:]
@@ -0,0 +1,125 @@
+import os
+import re
+import time
+import zlib
+import sqlite3
+import calendar
+from lrucache import LRUCache
+
+# Partition lengths in seconds and file name formats
+PARTITIONS = {
+    'day': (86400, '%Y%m%d'),
+    'hour': (3600, '%Y%m%d%H'),
+}
+PARTITION_RE = re.compile(r'^(\d{8}|\d{10})\.db$')
+COMPRESS_LEVEL = 6
+# SQLite allows 999 variables in a query
+QUERY_LIMIT = 500
+# Cache size is in megabytes, an entry is a changeset xml string of about a kilobyte
+CACHE_MEMORY = 16
+ENTRY_SIZE = 1500
+
+
+class ChangesetCache(object):
+    """Keeps changeset xml strings compressed with zlib, in a separate SQLite
+    file for each day or hour. Changesets are written to the partition for the
+    current time and looked up from the newest one, so updated changesets
+    replace old versions. Expired changesets are removed with their files,
+    without touching the main database. Recently used strings are kept
+    in an LRU cache."""
+
+    def __init__(self, path, partition='day', keep_seconds=2 * 86400, memory=CACHE_MEMORY):
+        self.path = path
+        self.period, self.name_format = PARTITIONS[partition]
+        self.keep_seconds = keep_seconds
+        self.lru = LRUCache.for_memory(memory, ENTRY_SIZE)
+        self.conns = {}
+        if not os.path.exists(path):
+            os.makedirs(path)
+        # (start, end, file name) tuples, newest first
+        self.partitions = []
+        for name in os.listdir(path):
+            if PARTITION_RE.match(name):
+                self.partitions.append(self._parse_name(name))
+        self.partitions.sort(reverse=True)
+
+    @staticmethod
+    def _parse_name(name):
+        key = name.split('.')[0]
+        period, name_format = PARTITIONS['day' if len(key) == 8 else 'hour']
+        start = calendar.timegm(time.strptime(key, name_format))
+        return (start, start + period, name)
+
+    def _conn(self, name):
+        conn = self.conns.get(name)
+        if conn is None:
+            conn = sqlite3.connect(os.path.join(self.path, name))
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.execute('PRAGMA synchronous = NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS changeset (id INTEGER PRIMARY KEY, xml BLOB)')
+            self.conns[name] = conn
+        return conn
+
+    def get_many(self, changesets):
+        """Returns a dict of xml strings for changesets that are in the cache."""
+        result = {}
+        missing = []
+        for ch in changesets:
+            xml = self.lru.get(ch)
+            if xml is None:
+                missing.append(ch)
+            else:
+                result[ch] = xml
+        for start, end, name in self.partitions:
+            if not missing:
+                break
+            conn = self._conn(name)
+            for i in range(0, len(missing), QUERY_LIMIT):
+                chunk = missing[i:i + QUERY_LIMIT]
+                query = 'SELECT id, xml FROM changeset WHERE id IN ({0})'.format(','.join('?' * len(chunk)))
+                for ch, blob in conn.execute(query, chunk):
+                    xml = zlib.decompress(blob)
+                    result[ch] = xml
+                    self.lru[ch] = xml
+            missing = [ch for ch in missing if ch not in result]
+        return result
+
+    def put_many(self, changesets, now=None):
+        """Writes a dict of xml strings in one transaction."""
+        if not changesets:
+            return
+        now = time.time() if now is None else now
+        start = int(now // self.period * self.period)
+        name = time.strftime(self.name_format, time.gmtime(start)) + '.db'
+        if name not in self.conns and not any(p[2] == name for p in self.partitions):
+            self.partitions.append((start, start + self.period, name))
+            self.partitions.sort(reverse=True)
+        conn = self._conn(name)
+        with conn:
+            conn.executemany('INSERT OR REPLACE INTO changeset (id, xml) VALUES (?, ?)',
+                             ((ch, sqlite3.Binary(zlib.compress(xml, COMPRESS_LEVEL)))
+                              for ch, xml in changesets.iteritems()))
+        for ch, xml in changesets.iteritems():
+            self.lru[ch] = xml
+
+    def expire(self, now=None):
+        """Deletes partitions that ended more than keep_seconds ago. Returns their number."""
+        limit = (time.time() if now is None else now) - self.keep_seconds
+        expired = [p for p in self.partitions if p[1] < limit]
+        for start, end, name in expired:
+            conn = self.conns.pop(name, None)
+            if conn is not None:
+                conn.close()
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(os.path.join(self.path, name + suffix)):
+                    os.remove(os.path.join(self.path, name + suffix))
+            self.partitions.remove((start, end, name))
+        return len(expired)
+
+    def stats(self):
+        return self.lru.stats()
+
+    def close(self):
+        for conn in self.conns.itervalues():
+            conn.close()
+        self.conns.clear()
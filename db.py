@@ -1,6 +1,51 @@
+import time
 from peewee import *
 
-database = SqliteDatabase(None)
+class CountingSqliteDatabase(SqliteDatabase):
+    """Counts queries executed through peewee, and time spent on them."""
+    query_count = 0
+    query_time = 0.0
+
+    def execute_sql(self, *args, **kwargs):
+        self.query_count += 1
+        start = time.time()
+        try:
+            return super(CountingSqliteDatabase, self).execute_sql(*args, **kwargs)
+        finally:
+            self.query_time += time.time() - start
+
+database = CountingSqliteDatabase(None)
+
+# Pragmas applied after connecting. The performance profile suits a single
+# writer: with WAL and synchronous=NORMAL a power loss can lose the last
+# transactions, but not corrupt the database. Changechange sets
+# synchronous=FULL when binary files are journaled.
+SQLITE_PROFILES = {
+    'default': (),
+    'performance': (
+        ('journal_mode', 'wal'),
+        ('synchronous', 'normal'),
+        # Negative values are in KiB, so this is 256 MB
+        ('cache_size', -262144),
+        ('mmap_size', 1 << 30),
+        ('temp_store', 'memory'),
+    ),
+    # Bulk imports sort and group billions of temporary rows, so they are
+    # kept in files, in SQLITE_TMPDIR if it is set
+    'import': (
+        ('journal_mode', 'wal'),
+        ('synchronous', 'normal'),
+        ('cache_size', -262144),
+        ('mmap_size', 1 << 30),
+        ('temp_store', 'file'),
+    ),
+}
+
+
+def apply_profile(name='performance'):
+    """Sets pragmas from SQLITE_PROFILES, outside of a transaction."""
+    for pragma, value in SQLITE_PROFILES[name]:
+        database.execute_sql('PRAGMA {0} = {1}'.format(pragma, value), require_commit=False)
 
 class BaseModel(Model):
     class Meta:
@@ -10,6 +55,7 @@ class State(BaseModel):
     changeset = IntegerField()
     replication = IntegerField()
 
+# Changesets are kept in changesetcache.py now, rows are moved there on start
 class Changeset(BaseModel):
     changeset = IntegerField(unique=True)
     timestamp = DateTimeField(index=True)
@@ -17,12 +63,12 @@ class Changeset(BaseModel):
 
 class NodeRef(BaseModel):
     node_id = IntegerField(unique=True)
-    refs = CharField(max_length=250)
+    refs = BlobField()
 
 class WayRelRef(BaseModel):
     wr_id = IntegerField(unique=True)
-    refs = CharField(max_length=250)
+    refs = BlobField()
 
 class Members(BaseModel):
     wr_id = IntegerField(unique=True)
-    members = TextField()
+    members = BlobField()
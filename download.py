@@ -0,0 +1,207 @@
+import os
+import threading
+import httplib
+import socket
+import urlparse
+from Queue import Queue
+from collections import deque
+
+MAX_REDIRECTS = 5
+
+
+class DownloadError(IOError):
+    pass
+
+
+class _SpoolReader(object):
+    """Reads from a response, writing raw bytes to a partial file, which
+    is renamed to the target path when the response has been read in full.
+    A response shorter than its Content-Length raises DownloadError."""
+
+    def __init__(self, response, path):
+        self.response = response
+        self.path = path
+        length = response.getheader('Content-Length')
+        self.length = int(length) if length and length.isdigit() else None
+        self.received = 0
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError:
+            # Another thread could have created it
+            if not os.path.isdir(os.path.dirname(path)):
+                raise
+        self.spool = open(path + '.part', 'wb')
+
+    def read(self, size=-1):
+        try:
+            data = self.response.read() if size < 0 else self.response.read(size)
+        except:
+            self._drop()
+            raise
+        if self.spool is not None:
+            self.spool.write(data)
+            self.received += len(data)
+            if size < 0 or not data:
+                # httplib returns an empty string when a connection is closed early
+                if self.length is not None and self.received != self.length:
+                    self._drop()
+                    raise DownloadError('Got {0} of {1} bytes for {2}'.format(
+                        self.received, self.length, self.path))
+                self.spool.close()
+                self.spool = None
+                os.rename(self.path + '.part', self.path)
+        return data
+
+    def _drop(self):
+        """Removes the partial file."""
+        if self.spool is not None:
+            self.spool.close()
+            self.spool = None
+            os.remove(self.path + '.part')
+
+    def close(self):
+        self._drop()
+        self.response.close()
+
+
+class _Task(object):
+    def __init__(self, url, spool):
+        self.url = url
+        self.spool = spool
+        self.data = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class Downloader(object):
+    """Downloads files over HTTP, reusing one keep-alive connection
+    per host in each thread. Several files can be fetched in parallel
+    with prefetch(), which returns them in the original order, or streamed
+    with open().
+
+    If a spool directory is given, files requested with spool=True are
+    kept there until discard() is called, and are not downloaded again.
+    A spooled file that could not be processed should be discarded too."""
+
+    def __init__(self, workers=4, depth=16, timeout=60, spool=None):
+        self.workers = workers
+        self.depth = depth
+        self.timeout = timeout
+        self.spool = spool
+        self.local = threading.local()
+        self.tasks = None
+
+    def _connection(self, scheme, host):
+        if not hasattr(self.local, 'connections'):
+            self.local.connections = {}
+        key = (scheme, host)
+        if key not in self.local.connections:
+            cls = httplib.HTTPSConnection if scheme == 'https' else httplib.HTTPConnection
+            self.local.connections[key] = cls(host, timeout=self.timeout)
+        return self.local.connections[key]
+
+    def _drop_connection(self, scheme, host):
+        conn = self.local.connections.pop((scheme, host), None)
+        if conn is not None:
+            conn.close()
+
+    def _request(self, url):
+        """Returns an httplib response, retrying once if a kept-alive connection was closed."""
+        u = urlparse.urlsplit(url)
+        path = u.path + ('?' + u.query if u.query else '')
+        for attempt in range(2):
+            conn = self._connection(u.scheme, u.netloc)
+            try:
+                conn.request('GET', path, headers={'Connection': 'keep-alive'})
+                return conn.getresponse()
+            except (httplib.HTTPException, socket.error):
+                self._drop_connection(u.scheme, u.netloc)
+                if attempt > 0:
+                    raise
+
+    def _response(self, url):
+        """Returns a response for the url, following redirects."""
+        for i in range(MAX_REDIRECTS):
+            response = self._request(url)
+            if response.status in (301, 302, 303, 307, 308):
+                response.read()
+                url = urlparse.urljoin(url, response.getheader('Location'))
+                continue
+            if response.status != 200:
+                response.read()
+                raise DownloadError('HTTP {0} {1} for {2}'.format(response.status, response.reason, url))
+            return response
+        raise DownloadError('Too many redirects for {0}'.format(url))
+
+    def fetch(self, url):
+        """Downloads a file and returns its contents."""
+        return self._response(url).read()
+
+    def _spool_path(self, url):
+        if self.spool is None:
+            return None
+        return os.path.join(self.spool, urlparse.urlsplit(url).path.lstrip('/'))
+
+    def _fetch_spooled(self, url):
+        source = self.open(url, True)
+        try:
+            return source.read()
+        finally:
+            source.close()
+
+    def open(self, url, spool=False):
+        """Returns a file object that reads the file while it is being downloaded."""
+        path = self._spool_path(url) if spool else None
+        if path is not None and os.path.exists(path):
+            return open(path, 'rb')
+        response = self._response(url)
+        if path is None:
+            return response
+        return _SpoolReader(response, path)
+
+    def discard(self, url):
+        """Removes a spooled copy of the file, after it has been processed."""
+        path = self._spool_path(url)
+        if path is not None and os.path.exists(path):
+            os.remove(path)
+
+    def _worker(self):
+        while True:
+            task = self.tasks.get()
+            try:
+                task.data = self._fetch_spooled(task.url) if task.spool else self.fetch(task.url)
+            except Exception as e:
+                task.error = e
+            task.done.set()
+
+    def _submit(self, url, spool):
+        if self.tasks is None:
+            self.tasks = Queue()
+            for i in range(self.workers):
+                t = threading.Thread(target=self._worker)
+                t.daemon = True
+                t.start()
+        task = _Task(url, spool)
+        self.tasks.put(task)
+        return task
+
+    def prefetch(self, urls, spool=False):
+        """Generates (url, data) tuples in the order of urls, downloading
+        at most `depth` files ahead of the consumer."""
+        urls = iter(urls)
+        pending = deque()
+        for url in urls:
+            pending.append(self._submit(url, spool))
+            if len(pending) >= self.depth:
+                break
+        while pending:
+            task = pending.popleft()
+            url = next(urls, None)
+            if url is not None:
+                pending.append(self._submit(url, spool))
+            # Waiting with a timeout keeps the main thread interruptible
+            while not task.done.wait(1):
+                pass
+            if task.error is not None:
+                raise task.error
+            yield (task.url, task.data)
@@ -0,0 +1,173 @@
+import time
+from lxml import etree
+import changelib
+import metrics
+
+TAGS = ('node', 'way', 'relation')
+
+
+def element_id(element):
+    """Returns an id for the database, negative for relations."""
+    el_id = int(element.get('id'))
+    return -el_id if element.tag == 'relation' else el_id
+
+
+class Stage(object):
+    """A step of enrichment. Methods named after element tags receive a list
+    of (action, element) tuples of that type, so lookups can be batched."""
+    name = 'stage'
+
+    def node(self, items):
+        pass
+
+    def way(self, items):
+        pass
+
+    def relation(self, items):
+        pass
+
+
+class CoordFormatter(object):
+    """Converts coordinates to strings once for nodes used many times."""
+
+    def __init__(self):
+        self.strings = {}
+
+    def set(self, element, node_id, t):
+        if t[0] is None or t[1] is None:
+            # We leave the possibility of an absent node
+            return
+        s = self.strings.get(node_id)
+        if s is None:
+            s = (str(t[0]), str(t[1]))
+            self.strings[node_id] = s
+        element.set('lat', s[0])
+        element.set('lon', s[1])
+
+
+class GeometryStage(Stage):
+    """Records changes in the database, and adds coordinates to way nodes
+    and relation node members. The pipeline always starts with it.
+    Time spent on recording each way and relation is tracked in metrics."""
+    name = 'geometry'
+
+    def node(self, items):
+        nodes = [el for action, el in items if el.get('lat')]
+        changelib.store_node_coords_batch([int(el.get('id')) for el in nodes],
+                                          [float(el.get('lat')) for el in nodes],
+                                          [float(el.get('lon')) for el in nodes])
+
+    def way(self, items):
+        way_nds = [el.findall('nd') for action, el in items]
+        # Add nodes to deleted ways, so their geometry is not empty
+        deleted = [i for i, (action, el) in enumerate(items) if action == 'delete' and not way_nds[i]]
+        for i, nodes in zip(deleted, changelib.fetch_way_nodes_many([int(items[i][1].get('id')) for i in deleted])):
+            for n in nodes:
+                nd = etree.SubElement(items[i][1], 'nd')
+                nd.set('ref', str(n))
+            way_nds[i] = items[i][1].findall('nd')
+        way_nodes = [[int(nd.get('ref')) for nd in nds] for nds in way_nds]
+        all_nodes = [n for nodes in way_nodes for n in nodes]
+        coords = CoordFormatter()
+        for nd, n, t in zip((nd for nds in way_nds for nd in nds), all_nodes, changelib.fetch_node_tuples(all_nodes)):
+            coords.set(nd, n, t)
+        for (action, el), nodes in zip(items, way_nodes):
+            start = time.time()
+            if action != 'delete':
+                changelib.update_way_nodes(int(el.get('id')), nodes)
+            else:
+                changelib.delete_wr(int(el.get('id')))
+            metrics.record_object('way', int(el.get('id')), time.time() - start)
+
+    def relation(self, items):
+        # We are not adding members to deleted relations, since we don't know their roles
+        node_members = [m for action, el in items for m in el.iterfind('member[@type="node"]')]
+        node_ids = [int(m.get('ref')) for m in node_members]
+        coords = CoordFormatter()
+        for m, n, t in zip(node_members, node_ids, changelib.fetch_node_tuples(node_ids)):
+            coords.set(m, n, t)
+        for action, el in items:
+            start = time.time()
+            if action != 'delete':
+                members = [m.get('type')[0] + m.get('ref') for m in el.iterfind('member')]
+                changelib.update_relation_members(element_id(el), members)
+            else:
+                changelib.delete_wr(element_id(el))
+            metrics.record_object('relation', int(el.get('id')), time.time() - start)
+
+
+def set_bbox(element, bbox):
+    element.set('minlat', str(bbox[0]))
+    element.set('minlon', str(bbox[1]))
+    element.set('maxlat', str(bbox[2]))
+    element.set('maxlon', str(bbox[3]))
+
+
+class BboxStage(Stage):
+    """Adds bounding boxes to relation way and relation members,
+    and a bounds element to relations that are not deleted."""
+    name = 'bbox'
+
+    def relation(self, items):
+        way_members = [m for action, el in items for m in el.iterfind('member[@type="way"]')]
+        for member, bbox in zip(way_members, changelib.fetch_way_bboxes([int(m.get('ref')) for m in way_members])):
+            if bbox is not None:
+                set_bbox(member, bbox)
+        rel_members = [m for action, el in items for m in el.iterfind('member[@type="relation"]')]
+        relations = [el for action, el in items if action != 'delete']
+        bboxes = changelib.fetch_relation_bboxes([-int(m.get('ref')) for m in rel_members] +
+                                                 [element_id(el) for el in relations])
+        for member, bbox in zip(rel_members, bboxes):
+            if bbox is not None:
+                set_bbox(member, bbox)
+        for el, bbox in zip(relations, bboxes[len(rel_members):]):
+            if bbox is not None:
+                bounds = etree.Element('bounds')
+                set_bbox(bounds, bbox)
+                el.insert(0, bounds)
+
+
+class RefsStage(Stage):
+    """Adds ways and relations referencing the element."""
+    name = 'refs'
+
+    def _add(self, items, refs_list):
+        for (action, el), refs in zip(items, refs_list):
+            for ref in refs:
+                refel = etree.SubElement(el, 'ref')
+                refel.set('type', 'way' if ref > 0 else 'relation')
+                refel.set('ref', str(ref))
+
+    def node(self, items):
+        self._add(items, changelib.fetch_node_refs_many([int(el.get('id')) for action, el in items]))
+
+    def way(self, items):
+        self._add(items, changelib.fetch_wr_refs_many([int(el.get('id')) for action, el in items]))
+
+    def relation(self, items):
+        self._add(items, changelib.fetch_wr_refs_many([element_id(el) for action, el in items]))
+
+
+class Pipeline(object):
+    """Runs enrichment stages on a list of (action, element) tuples. Each stage
+    processes all elements of a type at once, nodes first, so ways get new
+    node coordinates. References are looked up after all changes are recorded."""
+
+    def __init__(self, bbox=True, refs=True):
+        self.stages = [GeometryStage()]
+        if bbox:
+            self.stages.append(BboxStage())
+        if refs:
+            self.stages.append(RefsStage())
+
+    def process(self, items):
+        by_tag = dict((tag, []) for tag in TAGS)
+        for action, element in items:
+            by_tag[element.tag].append((action, element))
+        for tag in TAGS:
+            metrics.add('elements.' + tag, len(by_tag[tag]))
+        for stage in self.stages:
+            for tag in TAGS:
+                if by_tag[tag]:
+                    with metrics.timer('enrich.{0}.{1}'.format(stage.name, tag)):
+                        getattr(stage, tag)(by_tag[tag])
@@ -0,0 +1,203 @@
+import zlib
+import time
+import struct
+import threading
+from Queue import Queue, Empty, Full
+from collections import deque
+
+BLOCK_SIZE = 128 * 1024
+READ_SIZE = 64 * 1024
+# Seconds between checks whether the reader was closed, while its queue is full
+PUT_TIMEOUT = 0.1
+
+
+class _Block(object):
+    def __init__(self, data, last):
+        self.data = data
+        self.last = last
+        self.result = None
+        self.done = threading.Event()
+
+
+class ParallelGzipWriter(object):
+    """A write-only file object producing a single-member gzip stream, with blocks
+    compressed in parallel threads, like pigz does. Each block is a raw deflate
+    stream ended with a sync flush, the last one is finished, so together they
+    make one valid deflate stream. zlib releases the GIL while compressing.
+    Without a preset dictionary the result is slightly bigger than with gzip."""
+
+    def __init__(self, filename, compresslevel=9, threads=4, block_size=BLOCK_SIZE):
+        self.f = open(filename, 'wb')
+        self.level = compresslevel
+        self.block_size = block_size
+        self.buffer = []
+        self.buffered = 0
+        self.crc = zlib.crc32('') & 0xffffffff
+        self.size = 0
+        self.pending = deque()
+        self.max_pending = threads * 2
+        self.tasks = Queue()
+        self.threads = []
+        for i in range(threads):
+            t = threading.Thread(target=self._worker)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+        # Header: magic, deflate, no flags, mtime, no extra flags, unknown OS
+        self.f.write('\x1f\x8b\x08\x00' + struct.pack('<L', int(time.time())) + '\x00\xff')
+
+    def _worker(self):
+        while True:
+            block = self.tasks.get()
+            if block is None:
+                break
+            c = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS)
+            block.result = c.compress(block.data) + c.flush(zlib.Z_FINISH if block.last else zlib.Z_SYNC_FLUSH)
+            block.done.set()
+
+    def _write_pending(self, keep):
+        while len(self.pending) > keep:
+            block = self.pending.popleft()
+            block.done.wait()
+            self.f.write(block.result)
+
+    def _submit(self, last):
+        data = ''.join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+        self.crc = zlib.crc32(data, self.crc) & 0xffffffff
+        self.size += len(data)
+        block = _Block(data, last)
+        self.pending.append(block)
+        self.tasks.put(block)
+        self._write_pending(self.max_pending)
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.block_size:
+            self._submit(False)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.f is None:
+            return
+        self._submit(True)
+        self._write_pending(0)
+        for t in self.threads:
+            self.tasks.put(None)
+        for t in self.threads:
+            t.join()
+        self.f.write(struct.pack('<LL', self.crc, self.size & 0xffffffff))
+        self.f.close()
+        self.f = None
+
+
+class ThreadedGunzipReader(object):
+    """A read-only file object that decompresses a gzip stream from another
+    file object in a background thread, so a parser reading from it works
+    in parallel. At most max_chunks decompressed chunks are kept in memory.
+
+    If a regular expression is given, the decompressed data is scanned with
+    it on the way, and matched groups are available in found().
+
+    A stream that ends before the gzip trailer raises IOError on read.
+    close() stops the thread, and should be called before closing fileobj."""
+
+    def __init__(self, fileobj, scan=None, max_chunks=64):
+        self.fileobj = fileobj
+        self.scan = scan
+        self.matches = set()
+        self.lock = threading.Lock()
+        self.chunks = Queue(max_chunks)
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+        self.closed = False
+        self.thread = threading.Thread(target=self._worker)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _scan(self, tail, data):
+        found = set(self.scan.findall(tail + data))
+        with self.lock:
+            self.matches.update(found)
+        # Keep the end of the chunk for matches that cross chunk boundaries
+        return data[-256:]
+
+    def _put(self, item):
+        """Puts an item into the queue. Returns False if the reader was closed meanwhile."""
+        while not self.closed:
+            try:
+                self.chunks.put(item, timeout=PUT_TIMEOUT)
+                return True
+            except Full:
+                pass
+        return False
+
+    def _worker(self):
+        try:
+            d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            tail = ''
+            while not self.closed:
+                data = self.fileobj.read(READ_SIZE)
+                if not data:
+                    break
+                while data:
+                    chunk = d.decompress(data)
+                    # Concatenated gzip members start a new decompressor
+                    data = d.unused_data
+                    if data:
+                        d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                    if chunk:
+                        if self.scan is not None:
+                            tail = self._scan(tail, chunk)
+                        if not self._put(chunk):
+                            return
+            if self.closed:
+                return
+            # Bytes after a finished stream are left unused, otherwise the input was cut
+            try:
+                d.decompress('\0')
+                finished = d.unused_data == '\0'
+            except zlib.error:
+                finished = False
+            if not finished:
+                raise IOError('Gzip stream ended unexpectedly')
+            self._put(None)
+        except Exception as e:
+            self._put(e)
+
+    def found(self):
+        """Returns a set of strings matched so far."""
+        with self.lock:
+            return set(self.matches)
+
+    def read(self, size=-1):
+        while not self.eof and (size < 0 or len(self.buffer) - self.pos < size):
+            chunk = self.chunks.get()
+            if chunk is None:
+                self.eof = True
+            elif isinstance(chunk, Exception):
+                self.eof = True
+                raise chunk
+            else:
+                self.buffer = self.buffer[self.pos:] + chunk
+                self.pos = 0
+        if size < 0:
+            size = len(self.buffer) - self.pos
+        data = self.buffer[self.pos:self.pos + size]
+        self.pos += len(data)
+        return data
+
+    def close(self):
+        """Stops the thread, which waits for at most one read from fileobj."""
+        self.closed = True
+        while True:
+            try:
+                self.chunks.get_nowait()
+            except Empty:
+                break
+        self.thread.join()
@@ -0,0 +1,135 @@
+import os
+import zlib
+import struct
+import numpy as np
+
+MAGIC = 'CCJ1'
+# Magic, sequence and number of files
+HEADER = struct.Struct('<4sqi')
+# Length of a file name and number of values
+FILE_HEADER = struct.Struct('<iq')
+CHECKSUM = struct.Struct('<I')
+
+
+class Journal(object):
+    """A redo log for BigMMap files, tied to a replication sequence.
+
+    During a diff, files keep written values in memory. Before the database
+    transaction with the new sequence is committed, write() saves the values
+    and syncs them to disk. After the commit, apply() writes them to the files
+    and removes the journal. A journal left by a crash is replayed by recover()
+    if its sequence was committed, or dropped otherwise, since the files
+    were not changed then.
+
+    Files are given as a dict of names to BigMMap objects."""
+
+    def __init__(self, filename, mmaps):
+        self.filename = filename
+        self.mmaps = mmaps
+
+    def begin(self):
+        for mm in self.mmaps.itervalues():
+            mm.begin_overlay()
+
+    def write(self, sequence):
+        """Writes pending values of all files with a checksum, and syncs the journal to disk."""
+        parts = [HEADER.pack(MAGIC, sequence, len(self.mmaps))]
+        for name, mm in sorted(self.mmaps.iteritems()):
+            offsets, raw = mm.pending_values()
+            parts.append(FILE_HEADER.pack(len(name), len(offsets)))
+            parts.append(name)
+            parts.append(offsets.astype('<i8').tobytes())
+            parts.append(raw.astype('<i4').tobytes())
+        data = ''.join(parts)
+        # The journal appears complete or not at all
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+            f.write(CHECKSUM.pack(zlib.crc32(data) & 0xffffffff))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self.filename)
+        _sync_dir(os.path.dirname(os.path.abspath(self.filename)))
+
+    def _write_files(self, values):
+        for name, (offsets, raw) in values.iteritems():
+            if name not in self.mmaps:
+                raise Exception('Journal has values for an unknown file {0}'.format(name))
+            self.mmaps[name].write_raw(offsets, raw)
+        for mm in self.mmaps.itervalues():
+            mm.flush()
+
+    def apply(self):
+        """Writes pending values to the files, flushes them and removes the journal."""
+        for mm in self.mmaps.itervalues():
+            mm.commit_overlay()
+            mm.flush()
+        self._remove()
+
+    def discard(self):
+        """Drops pending values and the journal, after a diff that was not committed."""
+        for mm in self.mmaps.itervalues():
+            mm.drop_overlay()
+        self._remove()
+
+    def _remove(self):
+        for filename in (self.filename, self.filename + '.tmp'):
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    def read(self):
+        """Returns the sequence and a dict of (offsets, values) arrays for files
+        from the journal. Returns None if there is no journal, or it is damaged."""
+        if not os.path.exists(self.filename):
+            return None
+        with open(self.filename, 'rb') as f:
+            data = f.read()
+        if len(data) < HEADER.size + CHECKSUM.size:
+            return None
+        data, checksum = data[:-CHECKSUM.size], CHECKSUM.unpack(data[-CHECKSUM.size:])[0]
+        if zlib.crc32(data) & 0xffffffff != checksum:
+            return None
+        magic, sequence, count = HEADER.unpack_from(data)
+        if magic != MAGIC:
+            return None
+        pos = HEADER.size
+        values = {}
+        for i in range(count):
+            name_length, length = FILE_HEADER.unpack_from(data, pos)
+            pos += FILE_HEADER.size
+            name = data[pos:pos + name_length]
+            pos += name_length
+            offsets = np.frombuffer(data, dtype='<i8', count=length, offset=pos)
+            pos += length * 8
+            raw = np.frombuffer(data, dtype='<i4', count=length, offset=pos)
+            pos += length * 4
+            values[name] = (offsets, raw)
+        return sequence, values
+
+    def recover(self, committed):
+        """Replays a journal left after a crash, if its sequence is the committed one,
+        and removes it. Returns the journal sequence and whether it was replayed,
+        or None when there was no journal."""
+        if not os.path.exists(self.filename):
+            self._remove()
+            return None
+        journal = self.read()
+        if journal is None:
+            # A damaged journal was not synced, so its transaction was not committed
+            self._remove()
+            return (None, False)
+        sequence, values = journal
+        replayed = sequence == committed
+        if replayed:
+            self._write_files(values)
+        self._remove()
+        return (sequence, replayed)
+
+
+def _sync_dir(path):
+    """Syncs a directory, so a renamed file is there after a power loss."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
@@ -0,0 +1,227 @@
+import os
+import sys
+import mmap
+import shutil
+import struct
+import numpy as np
+from os.path import join
+from bigmmap import BigMMap, MODE_PAGED, MODE_WHOLE, MADV_RANDOM
+from refstore import BaseRefStore, EMPTY
+
+KV_DIR = 'kv'
+# Log offsets are in 8-byte words, split in two 30-bit halves,
+# so both fit into an int32 BigMMap value
+OFFSET_BITS = 30
+OFFSET_MASK = (1 << OFFSET_BITS) - 1
+# Number of log records checked against the index at once when scanning
+SCAN_BATCH = 10000
+# Masked arrays cost more than reading a few values one by one
+MIN_BATCH = 16
+# Log size in words at the last flush
+END = struct.Struct('<q')
+
+
+class KVTable(object):
+    """Lists of int64 numbers in an append-only log with an index.
+    A log record is a key, a number of values and the values. The index
+    is a BigMMap with an offset of the latest record for every key,
+    so a list is replaced by appending a record and updating the index.
+    Lists are read as numpy views into a read-only map of the log."""
+
+    def __init__(self, path, name, signed, mode):
+        self.signed = signed
+        self.index = BigMMap(join(path, name + '.idx'), mode=mode, advice=MADV_RANDOM)
+        self.log = os.fdopen(os.open(join(path, name + '.log'), os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644), 'a+b')
+        self.end_path = join(path, name + '.end')
+        self.log.seek(0, 2)
+        length = self.log.tell()
+        self.size = self._complete_size(length)
+        if self.size << 3 != length:
+            # Appends go to the end of the file, so a torn record would shift all later ones
+            os.ftruncate(self.log.fileno(), self.size << 3)
+            self.log.seek(0, 2)
+        self.words = None
+
+    def _complete_size(self, length):
+        """Returns the log size in words up to the end of the last complete
+        record, walking records written after the last flush."""
+        size = length >> 3
+        start = None
+        if os.path.exists(self.end_path):
+            with open(self.end_path, 'rb') as f:
+                data = f.read()
+            if len(data) == END.size:
+                start = END.unpack(data)[0]
+        if start is None or start > size:
+            # Without a checkpoint, only a log with a torn word is walked, from the start
+            if size << 3 == length:
+                return size
+            start = 0
+        if start == size:
+            return size
+        words = np.frombuffer(mmap.mmap(self.log.fileno(), size << 3, access=mmap.ACCESS_READ), dtype='<i8')
+        pos = start
+        while pos + 2 <= size and words[pos + 1] > 0 and pos + 2 + words[pos + 1] <= size:
+            pos += int(words[pos + 1]) + 2
+        return pos
+
+    def _slots(self, keys):
+        """Keys of signed tables are interleaved: even slots for positive ids, odd for negative."""
+        keys = np.asarray(keys, dtype=np.int64)
+        if not self.signed:
+            return keys
+        return np.where(keys >= 0, keys * 2, -keys * 2 - 1)
+
+    def _view(self):
+        """Returns the log as an int64 array, mapping it again when it has grown."""
+        if self.words is None or len(self.words) < self.size:
+            if self.size == 0:
+                return EMPTY
+            self.log.flush()
+            # Old maps are not closed: they are released with the last array using them
+            self.words = np.frombuffer(mmap.mmap(self.log.fileno(), self.size << 3, access=mmap.ACCESS_READ), dtype='<i8')
+        return self.words
+
+    def _offsets(self, keys):
+        """Returns an array of log offsets for keys, -1 for missing ones."""
+        records = self.index.get_records(self._slots(keys), 2)
+        missing = np.ma.getmaskarray(records).any(axis=1)
+        records = records.filled(0).astype(np.int64)
+        offsets = (records[:, 0] << OFFSET_BITS) | records[:, 1]
+        offsets[missing] = -1
+        return offsets
+
+    def get(self, key):
+        slot = (key * 2 if key >= 0 else -key * 2 - 1) if self.signed else key
+        hi = self.index[slot * 2]
+        if hi is None:
+            return EMPTY
+        offset = (hi << OFFSET_BITS) | self.index[slot * 2 + 1]
+        words = self._view()
+        return words[offset + 2:offset + 2 + words[offset + 1]]
+
+    def get_many(self, keys):
+        keys = list(set(keys))
+        if len(keys) < MIN_BATCH:
+            return dict((key, self.get(key)) for key in keys)
+        result = dict.fromkeys(keys, EMPTY)
+        offsets = self._offsets(keys)
+        if (offsets >= 0).any():
+            words = self._view()
+            for key, offset in zip(keys, offsets.tolist()):
+                if offset >= 0:
+                    result[key] = words[offset + 2:offset + 2 + words[offset + 1]]
+        return result
+
+    def set_many(self, items):
+        """Appends non-empty lists to the log in one write, then updates the index."""
+        keys = list(items)
+        if not keys:
+            return
+        chunks = []
+        offsets = []
+        pos = self.size
+        for key in keys:
+            ids = items[key]
+            if len(ids) == 0:
+                offsets.append(None)
+                continue
+            offsets.append(pos)
+            chunks.append(np.array([key, len(ids)], dtype='<i8').tobytes())
+            chunks.append(np.asarray(ids, dtype='<i8').tobytes())
+            pos += len(ids) + 2
+        if chunks:
+            self.log.write(''.join(chunks))
+            self.log.flush()
+            self.size = pos
+        # The index is updated after the log, so it never points past the data
+        self.index.set_records(self._slots(keys), 2, [
+            (None, None) if o is None else (o >> OFFSET_BITS, o & OFFSET_MASK) for o in offsets])
+
+    def items(self):
+        """Iterates over (key, list) pairs in the log order, skipping replaced records."""
+        words = self._view()
+        pos = 0
+        while pos < len(words):
+            batch = []
+            while pos < len(words) and len(batch) < SCAN_BATCH:
+                batch.append((int(words[pos]), pos))
+                pos += int(words[pos + 1]) + 2
+            offsets = self._offsets([key for key, offset in batch])
+            for (key, offset), latest in zip(batch, offsets.tolist()):
+                if offset == latest:
+                    yield key, words[offset + 2:offset + 2 + words[offset + 1]]
+
+    def flush(self):
+        self.log.flush()
+        os.fsync(self.log.fileno())
+        self.index.flush()
+        # The log ends with a complete record here, so it is checked only after this point on open
+        with open(self.end_path + '.tmp', 'wb') as f:
+            f.write(END.pack(self.size))
+        os.rename(self.end_path + '.tmp', self.end_path)
+
+    def close(self):
+        self.flush()
+        self.log.close()
+        self.index.close()
+        self.words = None
+
+
+class KVRefStore(BaseRefStore):
+    """Stores lists of ids in memory-mapped files, one KVTable for
+    each table, instead of SQLite. There are no transactions: like
+    nodes.bin and ways.bin, indexes are covered by the journal, and records
+    in logs are not visible until indexes point to them. Replaced
+    lists stay in logs as garbage, migrate.py rewrites logs without it."""
+
+    # File names, and whether keys can be negative
+    FILES = {
+        BaseRefStore.NODE_REFS: ('noderef', False),
+        BaseRefStore.WR_REFS: ('wayrelref', True),
+        BaseRefStore.MEMBERS: ('members', True),
+    }
+
+    def __init__(self, path, mode=None, directory=KV_DIR):
+        path = join(path, directory)
+        if not os.path.exists(path):
+            os.makedirs(path)
+        if mode is None:
+            mode = MODE_WHOLE if sys.maxsize > 2 ** 32 else MODE_PAGED
+        self.tables = dict((table, KVTable(path, name, signed, mode))
+                           for table, (name, signed) in self.FILES.iteritems())
+
+    @staticmethod
+    def exists(path, directory=KV_DIR):
+        return os.path.isdir(join(path, directory))
+
+    @staticmethod
+    def remove(path, directory=KV_DIR):
+        shutil.rmtree(join(path, directory))
+
+    def _get(self, table, key):
+        return self.tables[table].get(key)
+
+    def _get_many(self, table, keys):
+        return self.tables[table].get_many(keys)
+
+    def _set(self, table, key, ids):
+        self.tables[table].set_many({key: ids})
+
+    def _set_many(self, table, items):
+        self.tables[table].set_many(items)
+
+    def _items(self, table):
+        return self.tables[table].items()
+
+    def mmaps(self):
+        # Lists are appended to logs, and are only visible through indexes
+        return dict(('kv.' + self.FILES[table][0], t.index) for table, t in self.tables.iteritems())
+
+    def flush(self):
+        for t in self.tables.itervalues():
+            t.flush()
+
+    def close(self):
+        for t in self.tables.itervalues():
+            t.close()
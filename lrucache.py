@@ -0,0 +1,62 @@
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """A dict-like cache that keeps at most max_size entries, evicting
+    the least recently used ones. Counts hits, misses and evictions."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @classmethod
+    def for_memory(cls, megabytes, entry_size):
+        """Creates a cache that fits into given memory, with an estimated size of an entry in bytes."""
+        return cls(max(1, megabytes * 1024 * 1024 // entry_size))
+
+    def get(self, key, default=None):
+        try:
+            value = self.data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self.data[key] = value
+        self.hits += 1
+        return value
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def __setitem__(self, key, value):
+        if key in self.data:
+            del self.data[key]
+        elif len(self.data) >= self.max_size:
+            self.data.popitem(last=False)
+            self.evictions += 1
+        self.data[key] = value
+
+    def discard(self, key):
+        self.data.pop(key, None)
+
+    def clear(self):
+        self.data.clear()
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {
+            'size': len(self.data),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': float(self.hits) / requests if requests else None,
+        }
+
+    def reset_stats(self):
+        self.hits = self.misses = self.evictions = 0
@@ -0,0 +1,143 @@
+import os
+import time
+import json
+import heapq
+from collections import Counter
+from functools import wraps
+
+# Number of slowest objects kept for a diff
+SLOWEST_COUNT = 10
+
+timers = Counter()
+calls = Counter()
+counters = Counter()
+slowest = []
+# Functions returning dicts of growing numbers, like cache hits,
+# which are reported as differences for a diff
+probes = []
+baseline = {}
+started = None
+
+
+class _Timer(object):
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        timers[self.name] += time.time() - self.start
+        calls[self.name] += 1
+
+
+def timer(name):
+    """Returns a context manager that adds its running time to a named timer.
+    Timers are inclusive: time of nested timers is counted in both."""
+    return _Timer(name)
+
+
+def timed(name):
+    """Decorates a function to count its calls and running time."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                timers[name] += time.time() - start
+                calls[name] += 1
+        return wrapper
+    return decorator
+
+
+def add(name, value=1):
+    counters[name] += value
+
+
+def record_object(tag, obj_id, seconds):
+    """Remembers the time spent on an object, if it is among the slowest."""
+    item = (seconds, tag, obj_id)
+    if len(slowest) < SLOWEST_COUNT:
+        heapq.heappush(slowest, item)
+    elif item > slowest[0]:
+        heapq.heapreplace(slowest, item)
+
+
+def add_probe(func):
+    probes.append(func)
+
+
+def _read_probes():
+    values = {}
+    for probe in probes:
+        values.update(probe())
+    return values
+
+
+def begin():
+    """Resets all timers and counters before processing a diff."""
+    global baseline, started
+    timers.clear()
+    calls.clear()
+    counters.clear()
+    del slowest[:]
+    baseline = _read_probes()
+    started = time.time()
+
+
+def end(**fields):
+    """Returns a summary record for the diff, with given fields added."""
+    seconds = time.time() - started
+    values = Counter(counters)
+    for name, value in _read_probes().iteritems():
+        values[name] += value - baseline.get(name, 0)
+    elements = sum(v for k, v in values.iteritems() if k.startswith('elements.'))
+    record = dict(fields)
+    record['time'] = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+    record['seconds'] = round(seconds, 4)
+    record['elements'] = elements
+    record['elements_per_second'] = round(elements / seconds, 1) if seconds > 0 else None
+    record['counters'] = dict((k, round(v, 6) if isinstance(v, float) else v) for k, v in values.iteritems())
+    for name in values:
+        if name.endswith('.hits'):
+            prefix = name[:-len('.hits')]
+            total = values[name] + values[prefix + '.misses']
+            record['counters'][prefix + '.hit_rate'] = round(float(values[name]) / total, 4) if total else None
+    record['timers'] = dict((name, {'seconds': round(timers[name], 4), 'calls': calls[name]}) for name in timers)
+    record['slowest'] = [{'type': tag, 'id': obj_id, 'seconds': round(s, 6)}
+                         for s, tag, obj_id in sorted(slowest, reverse=True)]
+    return record
+
+
+def _prometheus_name(name):
+    return 'changechange_' + ''.join(c if c.isalnum() else '_' for c in name)
+
+
+def format_prometheus(record):
+    """Returns record numbers as Prometheus text exposition format."""
+    lines = []
+    for key in ('sequence', 'seconds', 'elements', 'elements_per_second'):
+        if record.get(key) is not None:
+            lines.append('{0} {1}'.format(_prometheus_name('diff_' + key), record[key]))
+    for name, value in sorted(record['counters'].iteritems()):
+        if value is not None:
+            lines.append('{0} {1}'.format(_prometheus_name(name), value))
+    for name, t in sorted(record['timers'].iteritems()):
+        lines.append('changechange_timer_seconds{{name="{0}"}} {1}'.format(name, t['seconds']))
+        lines.append('changechange_timer_calls{{name="{0}"}} {1}'.format(name, t['calls']))
+    return '\n'.join(lines) + '\n'
+
+
+def write(record, filename, fmt='json'):
+    """Appends a record to a file as a JSON line, or replaces a Prometheus textfile."""
+    if fmt == 'prometheus':
+        # A textfile collector may read it at any time, so it is replaced atomically
+        with open(filename + '.tmp', 'w') as f:
+            f.write(format_prometheus(record))
+        os.rename(filename + '.tmp', filename)
+    else:
+        with open(filename, 'a') as f:
+            f.write(json.dumps(record, sort_keys=True) + '\n')
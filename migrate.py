@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+import os, sys, time, argparse
+from db import database, apply_profile, NodeRef, WayRelRef, Members
+from refstore import BaseRefStore, SqlRefStore
+from kvstore import KVRefStore, KV_DIR
+from changelib import detect_backend
+
+TABLES = (BaseRefStore.NODE_REFS, BaseRefStore.WR_REFS, BaseRefStore.MEMBERS)
+# Number of lists written to the target store at once
+BATCH_SIZE = 100000
+
+
+def copy_refs(source, target, batch_size=BATCH_SIZE):
+    """Copies all reference lists from one store to another. Returns numbers of lists by table name."""
+    counts = {}
+    for table in TABLES:
+        name = table[0]._meta.db_table
+        counts[name] = 0
+        batch = {}
+        for key, ids in source._items(table):
+            batch[key] = ids
+            if len(batch) >= batch_size:
+                target._set_many(table, batch)
+                counts[name] += len(batch)
+                batch = {}
+                sys.stdout.write('\rCopying {0}: {1}'.format(name, counts[name]))
+                sys.stdout.flush()
+        target._set_many(table, batch)
+        counts[name] += len(batch)
+        print '\rCopied {0}: {1}'.format(name, counts[name])
+    target.flush()
+    return counts
+
+
+def to_kv(path, keep=False):
+    """Copies SQLite tables into key-value files, or rewrites key-value
+    files without replaced lists, when they are used already."""
+    if detect_backend(path) == 'kv':
+        new_dir = KV_DIR + '.new'
+        if KVRefStore.exists(path, new_dir):
+            KVRefStore.remove(path, new_dir)
+        source = KVRefStore(path)
+        target = KVRefStore(path, directory=new_dir)
+        copy_refs(source, target)
+        source.close()
+        target.close()
+        KVRefStore.remove(path)
+        os.rename(os.path.join(path, new_dir), os.path.join(path, KV_DIR))
+        return
+    target = KVRefStore(path)
+    try:
+        copy_refs(SqlRefStore(), target)
+    except:
+        # Without the directory, the database keeps being used
+        target.close()
+        KVRefStore.remove(path)
+        raise
+    target.close()
+    if not keep:
+        print 'Clearing tables'
+        for model in (NodeRef, WayRelRef, Members):
+            model.delete().execute()
+        database.execute_sql('VACUUM', require_commit=False)
+
+
+def to_sqlite(path):
+    """Copies key-value files into SQLite tables and deletes the files."""
+    source = KVRefStore(path)
+    with database.atomic():
+        for model in (NodeRef, WayRelRef, Members):
+            model.delete().execute()
+        copy_refs(source, SqlRefStore())
+    source.close()
+    KVRefStore.remove(path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Converts stored reference lists between backends. '
+                                     'Changechange should not be running.')
+    parser.add_argument('path', nargs='?', help='Directory with the database')
+    parser.add_argument('--to', choices=('kv', 'sqlite'), default='kv',
+                        help='Target backend. Converting to the current one rewrites key-value files without garbage')
+    parser.add_argument('--keep', action='store_true',
+                        help='Do not clear SQLite tables after copying them to key-value files')
+    options = parser.parse_args()
+
+    path = options.path if options.path and os.path.exists(options.path) else os.path.dirname(sys.argv[0])
+    database.init(os.path.join(path, 'changechange.db'))
+    database.connect()
+    apply_profile()
+    database.create_tables([NodeRef, WayRelRef, Members], safe=True)
+    start = time.time()
+    if options.to == 'kv':
+        to_kv(path, options.keep)
+    elif detect_backend(path) == 'sqlite':
+        print 'Reference lists are stored in SQLite already.'
+        sys.exit(1)
+    else:
+        to_sqlite(path)
+    database.close()
+    print 'Done in {0:.1f} s'.format(time.time() - start)
@@ -0,0 +1,97 @@
+import os
+import gzip
+from collections import OrderedDict
+from lxml import etree
+from gzipstream import ParallelGzipWriter
+import metrics
+
+COMPRESS_LEVEL = 9
+
+
+class _TimedOutput(object):
+    """Tracks time spent on compressing and writing output, which is
+    included in the output.write timer with xml serialization."""
+
+    def __init__(self, output):
+        self.output = output
+
+    def write(self, data):
+        with metrics.timer('output.compress'):
+            self.output.write(data)
+
+    def close(self):
+        with metrics.timer('output.compress'):
+            self.output.close()
+
+
+class OscWriter(object):
+    """Writes an osmChange file incrementally with lxml's xmlfile, keeping
+    one action block open for a run of elements with the same action.
+    Changesets are written between action blocks. With threads > 0,
+    the output is compressed in that many parallel threads.
+
+    Used as a context manager, it deletes the file if the block fails."""
+
+    def __init__(self, filename, compresslevel=COMPRESS_LEVEL, threads=0):
+        self.filename = filename
+        if threads > 0:
+            self.output = ParallelGzipWriter(filename, compresslevel, threads)
+        else:
+            self.output = gzip.GzipFile(filename, 'wb', compresslevel)
+        self.output = _TimedOutput(self.output)
+        self.context = etree.xmlfile(self.output, encoding='utf-8')
+        self.xf = self.context.__enter__()
+        self.xf.write_declaration()
+        self.root = self.xf.element('osmChange', OrderedDict((('version', '0.6'), ('generator', 'Changechange'))))
+        self.root.__enter__()
+        self.xf.write('\n')
+        self.action = None
+        self.block = None
+
+    def _close_block(self):
+        if self.block is not None:
+            self.block.__exit__(None, None, None)
+            self.xf.write('\n')
+            self.block = None
+            self.action = None
+
+    @metrics.timed('output.write')
+    def write_changeset(self, xml):
+        """Writes a changeset element from an xml string."""
+        self._close_block()
+        self.xf.write(etree.fromstring(xml))
+        self.xf.write('\n')
+
+    @metrics.timed('output.write')
+    def write(self, action, element):
+        if action != self.action:
+            self._close_block()
+            self.block = self.xf.element(action)
+            self.block.__enter__()
+            self.xf.write('\n')
+            self.action = action
+        self.xf.write(element)
+
+    @metrics.timed('output.write')
+    def close(self):
+        self._close_block()
+        self.root.__exit__(None, None, None)
+        self.context.__exit__(None, None, None)
+        self.output.close()
+
+    def discard(self):
+        """Closes the output after a failure, and deletes the incomplete file."""
+        # With an exception, xmlfile does not close open elements
+        self.context.__exit__(IOError, IOError('Discarded'), None)
+        self.output.close()
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.discard()
+        else:
+            self.close()
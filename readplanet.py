@@ -1,32 +1,29 @@
 #!/usr/bin/env python
-import changelib, sys, os, subprocess
-from db import database, NodeRef, WayRelRef, Members
+import changelib, sys, os, argparse, multiprocessing
+import numpy as np
+from db import database, apply_profile, NodeRef, WayRelRef, Members
+from bulkload import BulkLoader, ParallelLoader, MAX_WORKERS
 from imposm.parser import OSMParser
 
 NODE_COUNT = 5000*1024*1024
 WAY_COUNT = NODE_COUNT / 10
 
-if len(sys.argv) < 2:
-    print 'Imports planet data into binary files for changechange.'
-    print 'Usage: {0} <planet_file.osm.pbf> [<path_to_db>]'.format(sys.argv[0])
-    sys.exit(1)
+parser = argparse.ArgumentParser(description='Imports planet data into binary files for changechange.')
+parser.add_argument('planet', help='Planet file, osm.pbf')
+parser.add_argument('path', nargs='?', help='Directory with the database')
+parser.add_argument('--incremental', action='store_true',
+                    help='Update objects one by one instead of a bulk import, for a non-empty database')
+parser.add_argument('-j', '--workers', type=int, default=min(multiprocessing.cpu_count(), MAX_WORKERS),
+                    help='Number of processes for a bulk import')
+options = parser.parse_args()
 
-path = os.path.dirname(sys.argv[0]) if len(sys.argv) < 3 or not os.path.exists(sys.argv[2]) else sys.argv[2]
+path = options.path if options.path and os.path.exists(options.path) else os.path.dirname(sys.argv[0])
 database.init(os.path.join(path, 'changechange.db'))
 
-if not os.path.exists(os.path.join(path, 'nodes.bin')):
-    print 'Creating files'
-    BLOCK_SIZE = 16*1024*1024
-    for name in (('nodes.bin', NODE_COUNT*12), ('ways.bin', WAY_COUNT*16)):
-        res = subprocess.call(['dd', 'if=/dev/zero', 'of='+os.path.join(path, name[0]), 'bs={0}'.format(BLOCK_SIZE), 'count={0}'.format(name[1]/BLOCK_SIZE)])
-        if res != 0:
-            print 'DD returned code', res
-            sys.exit(1)
-
-
 class ParserForChange():
-    def __init__(self):
+    def __init__(self, loader=None):
         self.cnt = 0
+        self.loader = loader
 
     def flush(self):
         self.cnt += 1
@@ -37,31 +34,66 @@ class ParserForChange():
     def print_state(self, typ, ident):
         sys.stdout.write('\rProcessing {0} {1:.1f}m{2}'.format(typ, ident / 1000000.0, ' ' * 10))
         sys.stdout.flush()
-        self.flush()
+        if not self.loader:
+            self.flush()
 
     def got_coords(self, coords_list):
-        for coords in coords_list:
-            self.print_state('node', coords[0])
-            changelib.store_node_coords_fast(coords[0], coords[2], coords[1])
+        if not coords_list:
+            return
+        self.print_state('node', coords_list[-1][0])
+        coords = np.array(coords_list)
+        if self.loader:
+            self.loader.add_coords(coords[:, 0].astype(np.int64), coords[:, 2], coords[:, 1])
+        else:
+            changelib.store_node_coords_many(coords[:, 0].astype(np.int64), coords[:, 2], coords[:, 1])
 
     def got_way(self, ways):
+        if self.loader:
+            if ways:
+                self.print_state('way', ways[-1][0])
+                self.loader.add_ways([(way[0], way[2]) for way in ways])
+            return
         for way in ways:
             self.print_state('way', way[0])
             changelib.update_way_nodes(way[0], way[2])
 
     def got_relation(self, relations):
-        for rel in relations:
-            self.print_state('relation', rel[0])
-            members = [x[1][0] + str(x[0]) for x in rel[2]]
-            changelib.update_relation_members(rel[0], members)
+        members = [(-rel[0], [x[1][0] + str(x[0]) for x in rel[2]]) for rel in relations]
+        if self.loader:
+            if relations:
+                self.print_state('relation', relations[-1][0])
+                self.loader.add_relations(members)
+            return
+        for rel in members:
+            self.print_state('relation', -rel[0])
+            changelib.update_relation_members(*rel)
 
 database.connect()
+apply_profile('import')
 database.create_tables([NodeRef, WayRelRef, Members], safe=True)
 changelib.CACHE = False
-changelib.open(path)
-p = ParserForChange()
-op = OSMParser(concurrency=1, coords_callback=p.got_coords,
-               ways_callback=p.got_way, relations_callback=p.got_relation)
-op.parse(sys.argv[1])
+# Loaders write to SQLite, migrate.py converts tables to other backends
+changelib.open(path, store='sqlite')
+# Files are sparse, so this is instant and only saves remapping while they grow
+changelib.node_mmap.reserve(NODE_COUNT * 3)
+changelib.bbox_mmap.reserve(WAY_COUNT * 4)
+if options.incremental:
+    p = ParserForChange()
+    op = OSMParser(concurrency=1, coords_callback=p.got_coords,
+                   ways_callback=p.got_way, relations_callback=p.got_relation)
+    op.parse(options.planet)
+else:
+    if options.workers > 1:
+        loader = ParallelLoader(path, min(options.workers, MAX_WORKERS))
+    else:
+        loader = BulkLoader()
+    p = ParserForChange(loader)
+    # Way bboxes are calculated after all nodes are stored, in finish()
+    op = OSMParser(concurrency=options.workers, coords_callback=p.got_coords,
+                   ways_callback=p.got_way, relations_callback=p.got_relation)
+    op.parse(options.planet)
+    print
+    print 'Building references'
+    loader.finish()
 print
 changelib.close()
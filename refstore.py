@@ -0,0 +1,273 @@
+import sqlite3
+import numpy as np
+from db import database, NodeRef, WayRelRef, Members
+
+MEMBER_TYPES = 'nwr'
+EMPTY = np.zeros(0, dtype=np.int64)
+
+
+def pack_ids(ids):
+    """Packs a list of ids into a blob of little-endian int64 numbers."""
+    return np.asarray(ids, dtype='<i8').tobytes()
+
+
+def encode_member(member):
+    """Converts a member string like 'w123' into a number with the type in two lowest bits."""
+    return (int(member[1:]) << 2) | MEMBER_TYPES.index(member[0])
+
+
+def decode_member(value):
+    return MEMBER_TYPES[value & 3] + str(value >> 2)
+
+
+def unpack_ids(blob, legacy_sign=1):
+    """Unpacks a blob into a read-only int64 array. Text values are
+    comma-separated lists from older databases, they are parsed once
+    and get replaced with blobs on the next write."""
+    if blob is None:
+        return EMPTY
+    if isinstance(blob, unicode):
+        return np.array([encode_member(x) if x[0] in MEMBER_TYPES else int(x) * legacy_sign
+                         for x in blob.split(',') if x], dtype=np.int64)
+    return np.frombuffer(blob, dtype='<i8').astype(np.int64, copy=False)
+
+
+class BaseRefStore(object):
+    """Stores lists of ids: back references from nodes, ways and relations,
+    and members of ways and relations. Lists of references are unordered,
+    so an element is removed by putting the last one in its place.
+    Subclasses implement getting and setting a list for a table and a key."""
+
+    # Tables are tuples of (model, key field name, value field name, sign of legacy text values)
+    NODE_REFS = (NodeRef, 'node_id', 'refs', 1)
+    # Relation ids were stored positive in text
+    WR_REFS = (WayRelRef, 'wr_id', 'refs', -1)
+    MEMBERS = (Members, 'wr_id', 'members', 1)
+
+    def _get(self, table, key):
+        raise NotImplementedError()
+
+    def _set(self, table, key, ids):
+        raise NotImplementedError()
+
+    def _get_many(self, table, keys):
+        """Returns a dict of lists for keys. Subclasses can read them in a batch."""
+        return {key: self._get(table, key) for key in keys}
+
+    def _set_many(self, table, items):
+        for key, ids in items.iteritems():
+            self._set(table, key, ids)
+
+    def _items(self, table):
+        """Iterates over all (key, list) pairs in a table."""
+        raise NotImplementedError()
+
+    def _add(self, table, key, value):
+        ids = self._get(table, key)
+        if value in ids:
+            return False
+        self._set(table, key, np.append(ids, value))
+        return True
+
+    def _remove(self, table, key, value):
+        ids = self._get(table, key)
+        pos = np.nonzero(ids == value)[0]
+        if len(pos) == 0:
+            return False
+        ids = ids.copy()
+        ids[pos[0]] = ids[-1]
+        self._set(table, key, ids[:-1])
+        return True
+
+    def node_refs(self, node_id):
+        """Returns references for a node, except the one stored in nodes.bin."""
+        return self._get(self.NODE_REFS, node_id)
+
+    def node_refs_many(self, node_ids):
+        return self._get_many(self.NODE_REFS, node_ids)
+
+    def add_node_ref(self, node_id, wr_id):
+        return self._add(self.NODE_REFS, node_id, wr_id)
+
+    def remove_node_ref(self, node_id, wr_id):
+        return self._remove(self.NODE_REFS, node_id, wr_id)
+
+    def wr_refs(self, wr_id):
+        """Returns ids of relations referencing a way or a relation (negative)."""
+        return self._get(self.WR_REFS, wr_id)
+
+    def wr_refs_many(self, wr_ids):
+        return self._get_many(self.WR_REFS, wr_ids)
+
+    def add_wr_ref(self, wr_id, rel_id):
+        return self._add(self.WR_REFS, wr_id, rel_id)
+
+    def remove_wr_ref(self, wr_id, rel_id):
+        return self._remove(self.WR_REFS, wr_id, rel_id)
+
+    def members(self, wr_id):
+        """Returns node ids for a way, or encoded members for a relation."""
+        return self._get(self.MEMBERS, wr_id)
+
+    def members_many(self, wr_ids):
+        return self._get_many(self.MEMBERS, wr_ids)
+
+    def set_members(self, wr_id, members):
+        self._set(self.MEMBERS, wr_id, members)
+
+    def mmaps(self):
+        """Returns a dict of BigMMap files the store writes to, for the journal."""
+        return {}
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class RefStore(BaseRefStore):
+    """Stores lists of ids in SQLite blobs."""
+    # SQLite allows 999 variables in a query
+    BATCH_SIZE = 400
+
+    def _get(self, table, key):
+        model, key_name, value_name, sign = table
+        try:
+            row = model.select(getattr(model, value_name)).where(getattr(model, key_name) == key).get()
+        except model.DoesNotExist:
+            return EMPTY
+        return unpack_ids(getattr(row, value_name), sign)
+
+    def _get_many(self, table, keys):
+        model, key_name, value_name, sign = table
+        keys = list(set(keys))
+        result = dict.fromkeys(keys, EMPTY)
+        key_field = getattr(model, key_name)
+        for i in range(0, len(keys), self.BATCH_SIZE):
+            query = model.select(key_field, getattr(model, value_name)).where(key_field << keys[i:i + self.BATCH_SIZE])
+            for row in query:
+                result[getattr(row, key_name)] = unpack_ids(getattr(row, value_name), sign)
+        return result
+
+    def _items(self, table):
+        model, key_name, value_name, sign = table
+        query = model.select(getattr(model, key_name), getattr(model, value_name)).tuples()
+        for key, value in query.iterator():
+            yield key, unpack_ids(value, sign)
+
+    def _set(self, table, key, ids):
+        model, key_name, value_name = table[:3]
+        if len(ids) == 0:
+            model.delete().where(getattr(model, key_name) == key).execute()
+        else:
+            model.insert(**{key_name: key, value_name: pack_ids(ids)}).on_conflict('REPLACE').execute()
+
+    def _set_many(self, table, items):
+        """Writes a dict of lists for a table, with a few queries."""
+        model, key_name, value_name = table[:3]
+        empty = [k for k, ids in items.iteritems() if len(ids) == 0]
+        rows = [{key_name: k, value_name: pack_ids(ids)} for k, ids in items.iteritems() if len(ids) > 0]
+        for i in range(0, len(empty), self.BATCH_SIZE):
+            model.delete().where(getattr(model, key_name) << empty[i:i + self.BATCH_SIZE]).execute()
+        for i in range(0, len(rows), self.BATCH_SIZE):
+            model.insert_many(rows[i:i + self.BATCH_SIZE]).on_conflict('REPLACE').execute()
+
+
+class SqlRefStore(RefStore):
+    """Same as RefStore, but runs SQL statements directly instead of building
+    peewee queries for every call. Statements are prepared once for each table,
+    and sqlite3 keeps them compiled in its cache, looked up by text. That is
+    why IN lists are padded to a power of two, so there are few of them."""
+    BATCH_SIZE = 512
+
+    def __init__(self):
+        self.statements = {}
+
+    def _sql(self, table):
+        sql = self.statements.get(table)
+        if sql is None:
+            model, key_name, value_name = table[:3]
+            names = {'t': model._meta.db_table, 'k': key_name, 'v': value_name}
+            sql = {
+                'get': 'SELECT "{v}" FROM "{t}" WHERE "{k}" = ?'.format(**names),
+                'get_many': 'SELECT "{k}", "{v}" FROM "{t}" WHERE "{k}" IN ({{0}})'.format(**names),
+                'set': 'INSERT OR REPLACE INTO "{t}" ("{k}", "{v}") VALUES (?, ?)'.format(**names),
+                'delete': 'DELETE FROM "{t}" WHERE "{k}" = ?'.format(**names),
+            }
+            self.statements[table] = sql
+        return sql
+
+    def _get(self, table, key):
+        row = database.execute_sql(self._sql(table)['get'], (key,), require_commit=False).fetchone()
+        if row is None:
+            return EMPTY
+        return unpack_ids(row[0], table[3])
+
+    def _get_many(self, table, keys):
+        keys = list(set(keys))
+        result = dict.fromkeys(keys, EMPTY)
+        sql = self._sql(table)['get_many']
+        for i in range(0, len(keys), self.BATCH_SIZE):
+            chunk = keys[i:i + self.BATCH_SIZE]
+            size = 1
+            while size < len(chunk):
+                size <<= 1
+            # Repeating a key does not change the result
+            chunk += [chunk[-1]] * (size - len(chunk))
+            for key, value in database.execute_sql(sql.format(','.join('?' * size)), chunk, require_commit=False):
+                result[key] = unpack_ids(value, table[3])
+        return result
+
+    def _set(self, table, key, ids):
+        if len(ids) == 0:
+            database.execute_sql(self._sql(table)['delete'], (key,))
+        else:
+            database.execute_sql(self._sql(table)['set'], (key, sqlite3.Binary(pack_ids(ids))))
+
+    def _set_many(self, table, items):
+        sql = self._sql(table)
+        cursor = database.get_cursor()
+        empty = [(k,) for k, ids in items.iteritems() if len(ids) == 0]
+        rows = [(k, sqlite3.Binary(pack_ids(ids))) for k, ids in items.iteritems() if len(ids) > 0]
+        if empty:
+            cursor.executemany(sql['delete'], empty)
+            database.query_count += 1
+        if rows:
+            cursor.executemany(sql['set'], rows)
+            database.query_count += 1
+
+
+class WriteBackRefStore(BaseRefStore):
+    """Keeps lists read from a store in memory, and writes changed ones
+    back in a batch on flush(). Meant to live for a single diff."""
+
+    def __init__(self, store):
+        self.store = store
+        self.rows = {}
+        self.dirty = {}
+
+    def _get(self, table, key):
+        rows = self.rows.setdefault(table, {})
+        ids = rows.get(key)
+        if ids is None:
+            ids = self.store._get(table, key)
+            rows[key] = ids
+        return ids
+
+    def _get_many(self, table, keys):
+        rows = self.rows.setdefault(table, {})
+        missing = [key for key in keys if key not in rows]
+        if missing:
+            rows.update(self.store._get_many(table, missing))
+        return {key: rows[key] for key in keys}
+
+    def _set(self, table, key, ids):
+        self.rows.setdefault(table, {})[key] = np.asarray(ids, dtype=np.int64)
+        self.dirty.setdefault(table, set()).add(key)
+
+    def flush(self):
+        for table, keys in self.dirty.iteritems():
+            rows = self.rows[table]
+            self.store._set_many(table, {k: rows[k] for k in keys})
+        self.dirty.clear()